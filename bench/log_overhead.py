@@ -0,0 +1,91 @@
+"""
+time spent in logging calls by threads doing reverse searches, with
+the handlers called inline vs from utils.init_logging(queue=True):
+
+    python -m bench.log_overhead -threads 8 -n 2000
+"""
+
+import os
+import time
+import logging
+import tempfile
+import threading
+
+from utils import (
+    ROOT,
+    arg,
+    parse_args,
+    get_logger,
+    init_logging,
+    stop_logging,
+)
+
+
+LOGGER = get_logger('bench')
+
+QUERY_URL = 'https://www.google.com/searchbyimage?hl=en&image_url=' \
+            'https://upload.wikimedia.org/wikipedia/commons/a/a1/img.jpg'
+
+
+def log_requests(n, out):
+    # a reverse search's START and DONE records, n times
+    start = time.perf_counter()
+    for i in range(n):
+        LOGGER.info('START Reverse #%s - %s', i, QUERY_URL)
+        LOGGER.info('DONE Reverse #%s [%s] - %s\n\t- Success on Proxy: %s',
+                    i, 'occidental college', QUERY_URL, None)
+    out.append(time.perf_counter() - start)
+
+
+def reset():
+    stop_logging()
+    logger = logging.getLogger(ROOT)
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        handler.close()
+    logger.filters.clear()
+
+
+def run(n_threads, n, queue, json_lines, stdout):
+    fd, path = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+    init_logging(file=path, stdout=stdout, queue=queue,
+                 json_lines=json_lines)
+    out = []
+    threads = [threading.Thread(target=log_requests, args=(n, out))
+               for _ in range(n_threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    callers = time.perf_counter() - start
+    reset()  # drains the queue
+    total = time.perf_counter() - start
+    size = os.path.getsize(path)
+    os.remove(path)
+    return callers, total, sum(out) / (2. * n * n_threads), size
+
+
+def main(n_threads, n, stdout):
+    print('%d threads x %d requests (2 records each)' % (n_threads, n))
+    print('%-16s %10s %10s %14s %10s' % ('mode', 'callers s', 'drained s',
+                                         'us/record', 'MB'))
+    for queue in False, True:
+        for json_lines in False, True:
+            callers, total, per_record, size = run(n_threads, n, queue,
+                                                   json_lines, stdout)
+            print('%-16s %10.2f %10.2f %14.1f %10.1f'
+                  % (('queue' if queue else 'inline')
+                     + (' json' if json_lines else ''),
+                     callers, total, 1e6 * per_record, size / 1024. ** 2))
+
+
+if __name__ == '__main__':
+    opts = parse_args(
+        arg('-threads', type=int, default=8),
+        arg('-n', type=int, default=2000),
+        # also write every record to stdout, as main.py does
+        arg('-stdout', action='store_true'),
+    )
+    main(opts.threads, opts.n, opts.stdout)
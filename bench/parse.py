@@ -0,0 +1,108 @@
+"""
+parse time and peak allocations per page, targeted extractors vs
+BeautifulSoup, on saved google pages:
+
+    python -m bench.parse -recording .cache/responses.sqlite
+    python -m bench.parse -kind reverse -pages page1.html page2.html
+"""
+
+import time
+import sqlite3
+import zlib
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+from utils import arg, parse_args
+from html_extract import extract_imgs, extract_card_text
+from image_search import get_imgs_from_soup
+from reverse_image_search import parse_reverse_prediction
+
+
+def bs4_imgs(text):
+    return get_imgs_from_soup(BeautifulSoup(text, 'lxml'))
+
+
+def bs4_card(text):
+    return parse_reverse_prediction(text, from_request=False, fast=False)
+
+
+PARSERS = {'search':  (extract_imgs, bs4_imgs),
+           'reverse': (extract_card_text, bs4_card)}
+
+
+def page_kind(url):
+    if '/searchbyimage' in url:
+        return 'reverse'
+    if '/search?' in url and 'tbm=isch' in url:
+        return 'search'
+
+
+def from_recording(path):
+    db = sqlite3.connect(path)
+    for url, body in db.execute('SELECT url, body FROM responses'
+                                ' WHERE status = 200'):
+        kind = page_kind(url)
+        if kind:
+            yield kind, zlib.decompress(body).decode('utf-8', 'replace')
+    db.close()
+
+
+def from_files(paths, kind):
+    for path in paths:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            yield kind, f.read()
+
+
+def measure(f, text, number):
+    try:
+        result = f(text)
+    except Exception:
+        result = None
+    tracemalloc.start()
+    try:
+        f(text)
+    except Exception:
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for _ in range(number):
+        try:
+            f(text)
+        except Exception:
+            pass
+    return result, (time.perf_counter() - start) / number, peak
+
+
+def main(pages, number):
+    totals = {}
+    for kind, text in pages:
+        fast, slow = PARSERS[kind]
+        r_fast, t_fast, m_fast = measure(fast, text, number)
+        r_slow, t_slow, m_slow = measure(slow, text, number)
+        t = totals.setdefault(kind, [0, 0, 0., 0., 0, 0, 0])
+        for j, v in enumerate((1, len(text), t_fast, t_slow, m_fast, m_slow,
+                               r_fast is not None and r_fast == r_slow)):
+            t[j] += v
+    for kind, (n, size, t_fast, t_slow, m_fast, m_slow, agree) in \
+            sorted(totals.items()):
+        print('%-8s %4d pages, %6.0f KB/page, %d/%d agree with bs4'
+              % (kind, n, size / n / 1024., agree, n))
+        print('  fast %8.2f ms/page %9.0f KB peak/page'
+              % (1e3 * t_fast / n, m_fast / n / 1024.))
+        print('  bs4  %8.2f ms/page %9.0f KB peak/page (%.1fx slower)'
+              % (1e3 * t_slow / n, m_slow / n / 1024.,
+                 t_slow / max(t_fast, 1e-12)))
+
+
+if __name__ == '__main__':
+    opts = parse_args(
+        arg('-recording'),
+        arg('-pages', nargs='*'),
+        arg('-kind', choices=sorted(PARSERS), default='reverse'),
+        arg('-n', '--number', type=int, default=5),
+    )
+    pages = list(from_recording(opts.recording)) if opts.recording \
+        else list(from_files(opts.pages or [], opts.kind))
+    main(pages, opts.number)
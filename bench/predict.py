@@ -0,0 +1,77 @@
+"""
+end to end prediction over saved runs: filter_predictions.predict on
+all of a run's words at once, and StreamingPredictor (main.py -pred) on
+them one at a time. exits non-zero if any word fails:
+
+    python -m bench.predict -root reverse-img-preds
+"""
+
+import os
+import sys
+import time
+import traceback
+
+from utils import arg, parse_args
+from nlp_utils import from_logs
+from results_store import lang_pair
+from filter_predictions import predict, StreamingPredictor
+
+
+def run_dirs(root):
+    # dirs holding <word>/preds.txt
+    return sorted({os.path.dirname(dirpath)
+                   for dirpath, _, files in os.walk(root)
+                   if 'preds.txt' in files})
+
+
+def check(run_dir, t):
+    word_preds = sorted(from_logs(run_dir), key=lambda s: s[0].lower())
+    errors = []
+
+    start = time.perf_counter()
+    try:
+        batch = list(predict(word_preds, t=t, query=True))
+    except Exception:
+        batch = None
+        errors.append(('predict', traceback.format_exc()))
+    t_batch = time.perf_counter() - start
+
+    predictor = StreamingPredictor(t=t, query=True)
+    streamed = []
+    start = time.perf_counter()
+    for word, preds in word_preds:
+        try:
+            result = predictor.predict(word, preds)
+            streamed.append(result[0] if result else None)
+        except Exception:
+            streamed.append(None)
+            errors.append((word, traceback.format_exc()))
+    t_stream = time.perf_counter() - start
+
+    # streamed tf-idf only sees the words so far, so some may differ
+    same = sum(a == b for a, b in zip(batch, streamed)) if batch else 0
+    print('%-40s %6d %10.2f %10.2f %8d %8d'
+          % (run_dir, len(word_preds), t_batch, t_stream, same,
+             len(errors)))
+    return errors
+
+
+def main(root, t=None):
+    print('%-40s %6s %10s %10s %8s %8s' % ('run', 'words', 'batch s',
+                                           'stream s', 'same', 'errors'))
+    errors = []
+    for run_dir in run_dirs(root):
+        target = t or lang_pair(os.path.abspath(run_dir))[1]
+        errors.extend(check(run_dir, target))
+    for word, err in errors[:5]:
+        print('\n%s:\n%s' % (word, err))
+    return not errors
+
+
+if __name__ == '__main__':
+    opts = parse_args(
+        arg('-root', default='reverse-img-preds'),
+        # target language, else from the run's <src>_to_<target> dir
+        arg('-t'),
+    )
+    sys.exit(0 if main(opts.root, opts.t) else 1)
@@ -0,0 +1,108 @@
+"""
+import time of the entry points: every top-level import of a script,
+run in a fresh interpreter, median of -n runs. with -ref, the same is
+measured on a checkout of that git ref, for a before/after:
+
+    python -m bench.startup -ref HEAD~1
+"""
+
+import os
+import sys
+import ast
+import shutil
+import tempfile
+import statistics
+import subprocess
+
+from utils import arg, parse_args
+
+
+TARGETS = 'quickpred.py', 'main.py', 'filter_predictions.py'
+
+TIMER = '''
+import time
+start = time.perf_counter()
+%s
+print(time.perf_counter() - start)
+'''
+
+
+def import_source(node):
+    # the statement back from its node (no ast.get_source_segment on 3.7)
+    names = ', '.join(alias.name + (' as ' + alias.asname
+                                    if alias.asname else '')
+                      for alias in node.names)
+    if isinstance(node, ast.Import):
+        return 'import ' + names
+    return 'from %s%s import %s' % ('.' * node.level, node.module or '',
+                                    names)
+
+
+def top_level_imports(path):
+    # the script's imports without running it (main.py parses args and
+    # makes dirs between them); imports inside ifs are left out
+    with open(path) as f:
+        source = f.read()
+    return '\n'.join(import_source(node)
+                     for node in ast.parse(source, path).body
+                     if isinstance(node, (ast.Import, ast.ImportFrom)))
+
+
+def time_imports(path, cwd, n):
+    code = TIMER % top_level_imports(os.path.join(cwd, path))
+    times = []
+    for _ in range(n):
+        proc = subprocess.run([sys.executable, '-c', code], cwd=cwd,
+                              capture_output=True, text=True)
+        if proc.returncode:
+            err = proc.stderr.strip().splitlines()
+            return None, err[-1] if err else 'failed'
+        times.append(float(proc.stdout.split()[-1]))
+    return statistics.median(times), None
+
+
+def checkout(ref):
+    path = tempfile.mkdtemp(prefix='startup-')
+    subprocess.run(['git', 'worktree', 'add', '--detach', path, ref],
+                   check=True, capture_output=True)
+    return path
+
+
+def remove(path):
+    subprocess.run(['git', 'worktree', 'remove', '--force', path],
+                   capture_output=True)
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def main(targets, n, ref=None):
+    trees = [('now', '.')]
+    if ref:
+        trees.insert(0, (ref, checkout(ref)))
+    errors = []
+    try:
+        print('%-24s' % 'target' + ''.join('%16s' % name
+                                           for name, _ in trees))
+        for target in targets:
+            cells = []
+            for name, cwd in trees:
+                secs, err = time_imports(target, cwd, n)
+                if err is not None:
+                    errors.append('%s (%s): %s' % (target, name, err))
+                cells.append('%15.3fs' % secs if err is None
+                             else '%16s' % 'error')
+            print('%-24s' % target + ''.join(cells))
+        for err in errors:
+            print(err)
+    finally:
+        if ref:
+            remove(trees[0][1])
+
+
+if __name__ == '__main__':
+    opts = parse_args(
+        arg('-targets', nargs='*', default=TARGETS),
+        arg('-n', type=int, default=5),
+        # also time this git ref, e.g. the commit before a change
+        arg('-ref'),
+    )
+    main(opts.targets, opts.n, opts.ref)
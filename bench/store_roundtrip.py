@@ -0,0 +1,73 @@
+"""
+results_store round trip: a copy of saved runs, plus a word with an
+empty preds.txt, imported into a fresh db and read back with
+nlp_utils.from_store, against nlp_utils.sort_by_word on the same dirs.
+exits non-zero if any run differs:
+
+    python -m bench.store_roundtrip -root reverse-img-preds
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from utils import arg, parse_args
+from nlp_utils import sort_by_word, from_store
+from results_store import ResultsStore, import_tree
+
+
+EMPTY_WORD = 'empty-preds'
+
+
+def copy_runs(root, dst):
+    # the runs under root, each with one more word that has no preds
+    shutil.copytree(root, dst)
+    run_dirs = sorted({os.path.dirname(dirpath)
+                       for dirpath, _, files in os.walk(dst)
+                       if 'preds.txt' in files})
+    for run_dir in run_dirs:
+        os.makedirs(os.path.join(run_dir, EMPTY_WORD))
+        open(os.path.join(run_dir, EMPTY_WORD, 'preds.txt'), 'w').close()
+    return run_dirs
+
+
+def main(root):
+    tmp = tempfile.mkdtemp(prefix='store-')
+    try:
+        tree = os.path.join(tmp, 'runs')
+        run_dirs = copy_runs(root, tree)
+        db = os.path.join(tmp, 'results.sqlite')
+        store = ResultsStore(db)
+        start = time.perf_counter()
+        import_tree(store, tree)
+        t_import = time.perf_counter() - start
+        store.close()
+
+        print('%-32s %6s %8s %8s %6s' % ('run', 'words', 'dirs s',
+                                         'db s', 'same'))
+        ok = True
+        for run_dir in run_dirs:
+            name = os.path.relpath(run_dir, tree)
+            start = time.perf_counter()
+            from_dirs = sort_by_word(run_dir)
+            t_dirs = time.perf_counter() - start
+            start = time.perf_counter()
+            from_db = [tuple(wv) for wv in from_store(db, name)]
+            t_db = time.perf_counter() - start
+            same = from_dirs == from_db
+            ok = ok and same
+            print('%-32s %6d %8.3f %8.3f %6s'
+                  % (name, len(from_dirs), t_dirs, t_db, same))
+        print('import: %.2fs' % t_import)
+        return ok
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    opts = parse_args(
+        arg('-root', default='reverse-img-preds'),
+    )
+    sys.exit(0 if main(opts.root) else 1)
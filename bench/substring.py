@@ -0,0 +1,70 @@
+"""
+word_row_feats' substring feature, the pairwise loop over token
+occurrences vs filter_predictions.substring_scores, on captions drawn
+from saved runs:
+
+    python -m bench.substring -root reverse-img-preds -sizes 20 200 2000
+"""
+
+import time
+import random
+
+import numpy as np
+
+from collections import Counter
+
+from utils import arg, parse_args, dedupe, RANDOM_SEED
+from nlp_utils import from_logs
+from filter_predictions import preds_to_words, substring_scores
+
+
+def pairwise(words):
+    # word_row_feats' loop before the index
+    seen = set()
+    substring_score = {}
+    for i in range(len(words)):
+        wi = words[i]
+        if wi not in seen:
+            seen.add(wi)
+            substring_score[wi] = np.mean([
+                wi in words[j] for j in range(len(words)) if j != i])
+    return substring_score
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return result, time.perf_counter() - start
+
+
+def main(root, sizes, max_pairwise):
+    captions = [p.lower() for _, preds in from_logs(root=root)
+                for p in preds if p.strip()]
+    rng = random.Random(RANDOM_SEED)
+    print('%8s %8s %8s %12s %12s %8s %6s'
+          % ('captions', 'tokens', 'unique', 'pairwise s', 'index s',
+             'speedup', 'same'))
+    for size in sizes:
+        sample = [rng.choice(captions) for _ in range(size)]
+        words = list(preds_to_words(sample))
+        deduped = list(dedupe(words))
+        fast, t_fast = timed(substring_scores, deduped, Counter(words))
+        if len(words) <= max_pairwise:
+            slow, t_slow = timed(pairwise, words)
+            same = slow == fast
+            print('%8d %8d %8d %12.4f %12.4f %7.0fx %6s'
+                  % (size, len(words), len(deduped), t_slow, t_fast,
+                     t_slow / max(t_fast, 1e-9), same))
+        else:
+            print('%8d %8d %8d %12s %12.4f %8s %6s'
+                  % (size, len(words), len(deduped), '-', t_fast, '-', '-'))
+
+
+if __name__ == '__main__':
+    opts = parse_args(
+        arg('-root', default='reverse-img-preds'),
+        arg('-sizes', type=int, nargs='*', default=[20, 200, 2000]),
+        # tokens past which the quadratic loop is skipped
+        arg('-max-pairwise', type=int, default=20000),
+    )
+    main(opts.root, opts.sizes, opts.max_pairwise)
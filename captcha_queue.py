@@ -0,0 +1,195 @@
+"""
+persistent queue of captcha'd reverse searches. the pipeline defers
+them here and moves on; this module's cli solves them by hand and
+merges each prediction into its word's preds.txt, and into the run's
+results_store db when it kept one:
+
+    python captcha_queue.py -q .cache/captchas.sqlite [-watch 60]
+"""
+
+import os
+import time
+import tempfile
+
+from utils import (
+    arg,
+    read_lines,
+    write_lines,
+    parse_args,
+    get_logger,
+    init_logging,
+    SqliteStore,
+)
+from results_store import ResultsStore, PRED
+
+
+LOGGER = get_logger(__name__)
+
+
+PENDING, DONE, FAILED = 'pending', 'done', 'failed'
+
+
+class CaptchaQueue(SqliteStore):
+    def __init__(self, path):
+        super().__init__(path)
+        self.stores = {}  # results_store dbs merged into, by path
+        self.db.execute('CREATE TABLE IF NOT EXISTS deferred ('
+                        ' id INTEGER PRIMARY KEY, preds_path TEXT,'
+                        ' pos INTEGER, url TEXT, query_url TEXT,'
+                        ' proxy TEXT, status TEXT, pred TEXT,'
+                        ' created REAL, resolved REAL, n_img INTEGER,'
+                        ' results TEXT, run TEXT, word TEXT)')
+        # queues made before these were kept
+        cols = [row[1] for row in
+                self.db.execute('PRAGMA table_info(deferred)')]
+        for col, type_ in (('n_img', 'INTEGER'), ('results', 'TEXT'),
+                           ('run', 'TEXT'), ('word', 'TEXT')):
+            if col not in cols:
+                self.db.execute('ALTER TABLE deferred ADD COLUMN %s %s'
+                                % (col, type_))
+        self.db.commit()
+
+    def put(self, preds_path, pos, url, query_url, proxy=None, n_img=None,
+            results=None, run=None, word=None):
+        # pos: number of preds in preds_path ranked before this image;
+        # n_img: preds the file may hold once this one is merged;
+        # results, run, word: the results_store db, run name and word
+        # the preds are also kept under
+        with self.lock:
+            self.db.execute('INSERT INTO deferred (preds_path, pos, url,'
+                            ' query_url, proxy, status, created, n_img,'
+                            ' results, run, word)'
+                            ' VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+                            (os.path.abspath(preds_path), pos, url,
+                             query_url, proxy, PENDING, time.time(),
+                             n_img, results and os.path.abspath(results),
+                             run, word))
+            self.db.commit()
+
+    def pending(self):
+        with self.lock:
+            return self.db.execute(
+                'SELECT id, preds_path, pos, url, query_url, proxy'
+                ' FROM deferred WHERE status = ? ORDER BY id',
+                (PENDING,)).fetchall()
+
+    def resolve(self, id_, pred):
+        with self.lock:
+            status = DONE if pred and pred.strip() else FAILED
+            row = self.db.execute('SELECT preds_path, pos, n_img, results,'
+                                  ' run, word FROM deferred WHERE id = ?',
+                                  (id_,)).fetchone()
+            if status == DONE:
+                self.merge(id_, pred.strip(), *row)
+            self.db.execute('UPDATE deferred SET status = ?, pred = ?,'
+                            ' resolved = ? WHERE id = ?',
+                            (status, pred, time.time(), id_))
+            self.db.commit()
+            return status
+
+    def merge(self, id_, pred, preds_path, pos, n_img=None, results=None,
+              run=None, word=None):
+        # callers hold the lock; earlier merges into the same file moved
+        # this image's slot down by one each, and the last pred falls
+        # off once there are n_img
+        offset = self.db.execute(
+            'SELECT COUNT(*) FROM deferred WHERE preds_path = ?'
+            ' AND status = ? AND (pos < ? OR pos = ? AND id < ?)',
+            (preds_path, DONE, pos, pos, id_)).fetchone()[0]
+        preds = read_lines(preds_path) if os.path.exists(preds_path) else []
+        preds.insert(pos + offset, pred)
+        if n_img is not None:
+            preds = preds[:n_img]
+        tmp_path = preds_path + '.tmp'
+        write_lines(preds, tmp_path)
+        os.replace(tmp_path, preds_path)
+        if results:
+            store = self.stores.get(results)
+            if store is None:
+                store = self.stores[results] = ResultsStore(results)
+            store.put(store.run_id(run), word, PRED, preds)
+
+    def stats(self):
+        return self.count_by('deferred', 'status')
+
+    def close(self):
+        for store in self.stores.values():
+            store.close()
+        super().close()
+
+
+### solver
+
+# what queues filled before proxies were stored as None hold instead
+NO_PROXY = 'NO PROXY'
+
+
+def solve(queue, duration=None, factory=None):
+    # one visible browser per captcha, solved by hand; factory(proxy)
+    # makes the browser, selenium_methods.proxy_driver by default
+    from selenium_methods import (
+        proxy_driver,
+        paused_browser,
+        parse_reverse_selenium,
+    )
+    factory = factory or proxy_driver
+    n = 0
+    for id_, preds_path, pos, url, query_url, proxy in queue.pending():
+        LOGGER.info('Solving #%s for %s: %s' % (id_, preds_path, query_url))
+        pred = None
+        driver = factory(None if proxy == NO_PROXY else proxy)
+        try:
+            pred = paused_browser(driver, query_url, duration=duration,
+                                  on_solve=parse_reverse_selenium,
+                                  quit=False)
+        except:
+            LOGGER.exception('Could not read a prediction for #%s' % id_)
+        finally:
+            driver.quit()
+        status = queue.resolve(id_, pred)
+        LOGGER.info('%s #%s [%s]' % (status.upper(), id_, pred))
+        n += 1
+    return n
+
+
+def check_solve(url, preds=('a', 'b', 'c'), pos=1, n_img=3, factory=None,
+                duration=.1):
+    # queues url (e.g. a local page with a card) as deferred at pos of a
+    # throwaway preds.txt, solves it and returns the merged preds
+    tmp = tempfile.mkdtemp(prefix='captchas-')
+    preds_path = os.path.join(tmp, 'preds.txt')
+    write_lines(list(preds), preds_path)
+    queue = CaptchaQueue(os.path.join(tmp, 'captchas.sqlite'))
+    try:
+        queue.put(preds_path, pos, url, url, NO_PROXY, n_img=n_img)
+        solve(queue, duration=duration, factory=factory)
+        return read_lines(preds_path), queue.stats()
+    finally:
+        queue.close()
+
+
+if __name__ == '__main__':
+    opts = parse_args(
+        arg('-q', '--queue', default=os.path.join('.cache',
+                                                  'captchas.sqlite')),
+        # poll for new captchas every this many seconds
+        arg('-watch', type=float),
+        # solve one throwaway row for this page instead, e.g. a local one
+        arg('-check'),
+    )
+    init_logging(stdout=True)
+    if opts.check:
+        print(check_solve(opts.check))
+        raise SystemExit
+    queue = CaptchaQueue(opts.queue)
+    try:
+        while True:
+            solve(queue)
+            LOGGER.info('Queue: %s' % queue.stats())
+            if not opts.watch:
+                break
+            time.sleep(opts.watch)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        queue.close()
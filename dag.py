@@ -0,0 +1,326 @@
+"""
+the run as a dag of content-hashed nodes:
+
+    words -> urls -> dedup -> captions -> predictions -> scores
+
+a node's key hashes its stage, version, params and the content hashes
+of its inputs, so asking for a target only computes nodes whose key
+isn't stored yet. captions are stored per image url: changing n_img or
+the filter settings never refetches one.
+
+    python dag.py -target scores -f train/french_clean -i 0 -j 50 -n 10
+"""
+
+import os
+import time
+import hashlib
+import threading
+
+from functools import partial
+from collections import Counter
+
+import ujson as json
+
+from utils import (
+    arg,
+    is_,
+    parse_args,
+    get_logger,
+    init_logging,
+    SqliteStore,
+)
+
+
+LOGGER = get_logger(__name__)
+
+
+STAGES = 'words', 'urls', 'dedup', 'captions', 'predictions', 'scores'
+
+
+### hashing
+
+def content_hash(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode()) \
+        .hexdigest()
+
+
+def node_key(stage, version, params, dep_hashes):
+    return content_hash([stage, version, params, dep_hashes])
+
+
+### store
+
+class NodeStore(SqliteStore):
+    def __init__(self, path):
+        super().__init__(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS nodes ('
+                        ' key TEXT PRIMARY KEY, stage TEXT, hash TEXT,'
+                        ' value TEXT, created REAL)')
+        self.db.commit()
+
+    def get(self, key):
+        # (hash, value) or None
+        with self.lock:
+            row = self.db.execute('SELECT hash, value FROM nodes'
+                                  ' WHERE key = ?', (key,)).fetchone()
+        if row:
+            return row[0], json.loads(row[1])
+
+    def put(self, key, stage, value, hash_=None):
+        hash_ = hash_ or content_hash(value)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO nodes'
+                            ' VALUES (?,?,?,?,?)',
+                            (key, stage, hash_, json.dumps(value),
+                             time.time()))
+            self.db.commit()
+        return hash_
+
+    def stats(self):
+        return self.count_by('nodes', 'stage')
+
+
+### graph
+
+class Node(object):
+    """
+    fn(*dep values, **params); params must be json-able. unstored nodes
+    are recomputed each time but still hashed by content, so stored
+    nodes downstream of them only change when their output does
+    """
+    def __init__(self, stage, fn, deps=(), params=None, version=1,
+                 store=True):
+        self.stage = stage
+        self.fn = fn
+        self.deps = list(deps)
+        self.params = params or {}
+        self.version = version
+        self.store = store
+
+
+class DAG(object):
+    def __init__(self, store, refresh=()):
+        # refresh: stages recomputed even when stored
+        self.store = store
+        self.refresh = set(refresh)
+        self.memo = {}
+        self.lock = threading.Lock()
+        self.n_computed, self.n_cached = Counter(), Counter()
+
+    def count(self, stage, cached=False, n=1):
+        with self.lock:
+            (self.n_cached if cached else self.n_computed)[stage] += n
+
+    def resolve(self, node):
+        # -> (content hash, value)
+        deps = [self.resolve(d) for d in node.deps]
+        key = node_key(node.stage, node.version, node.params,
+                       [h for h, _ in deps])
+        if key in self.memo:
+            return self.memo[key]
+        hit = None
+        if node.store and node.stage not in self.refresh:
+            hit = self.store.get(key)
+        self.count(node.stage, cached=bool(hit))
+        if not hit:
+            value = node.fn(*[v for _, v in deps], **node.params)
+            # empty results are failures more often than not: retry them
+            if node.store and value:
+                hit = self.store.put(key, node.stage, value), value
+            else:
+                hit = content_hash(value), value
+        self.memo[key] = hit
+        return hit
+
+    def get(self, node):
+        return self.resolve(node)[1]
+
+    def report(self):
+        return {stage: '%s computed, %s stored' % (self.n_computed[stage],
+                                                   self.n_cached[stage])
+                for stage in set(self.n_computed) | set(self.n_cached)}
+
+
+### stages
+
+def words_stage(file=None, start=None, stop=None, query=None):
+    from nlp_utils import get_words
+    words = list(get_words(file, i=start, j=stop)) if file else []
+    return words + list(query or [])
+
+
+def urls_stage(word, lang):
+    from image_search import image_search
+    return list(image_search(word, lang) or [])
+
+
+def dedup_stage(urls, dist):
+    # all urls are hashed, whatever n_img, so it doesn't key this node
+    if dist is None:
+        return urls
+    from image_search import dedupe_urls
+    return dedupe_urls(urls, dist)
+
+
+def caption_key(url, lang):
+    return node_key('caption', 1, {'url': url, 'lang': lang}, [])
+
+
+def captions_stage(dag, urls, word, lang, n_img, n_workers=None):
+    # per-url captions come from the store; only the missing ones are
+    # searched, and each is stored as it arrives. -refresh captions
+    # searches them all again
+    from reverse_image_search import reverse_search_urls
+    known = {}
+    for url in urls if 'captions' not in dag.refresh else ():
+        hit = dag.store.get(caption_key(url, lang))
+        if hit:
+            known[url] = hit[1]
+    dag.count('caption', cached=True, n=len(known))
+
+    def on_result(i, url, pred):
+        dag.count('caption')
+        if pred:
+            dag.store.put(caption_key(url, lang), 'caption', pred)
+
+    return reverse_search_urls(word, *urls, lang=lang, n_img=n_img,
+                               n_workers=n_workers, known=known,
+                               on_result=on_result)
+
+
+def stop_word_set(kind, lang):
+    # kind: 'nltk' or 'alt', see nlp_utils
+    if not kind:
+        return ()
+    from nlp_utils import stop_words
+    return stop_words(kind, lang)
+
+
+def predictions_stage(words, *captions, k=None, t='fr', query=False,
+                      lang=False, stop=None, fuzzy='fuzzywuzzy'):
+    from filter_predictions import predict
+    preds = predict(zip(words, captions), stop_word_set(stop, t), k=k, t=t,
+                    query=query, lang=lang, fuzzy=fuzzy)
+    return list(zip(words, preds))
+
+
+def labels_stage(path):
+    from nlp_utils import read_dictfile
+    return list(read_dictfile(path))
+
+
+def scores_stage(predictions, labels, src='fr', t='en'):
+    from filter_predictions import scorer
+    from nlp_utils import get_pos
+    by_word = {d['w']: d for d in labels}
+    labeled = [(pred, by_word[w]) for w, pred in predictions if w in by_word]
+    if not labeled:
+        return
+    preds, labels = zip(*labeled)
+    pos_counts = Counter(get_pos(d, src, t) for d in labels)
+    score, pos_scores = scorer(preds, labels, pos_counts, src, t)
+    return {'score': score,
+            'pos_scores': {str(pos): s for pos, s in pos_scores.items()},
+            'n_labeled': len(labeled), 'n_words': len(predictions)}
+
+
+def build(dag, target, file=None, start=None, stop=None, query=None,
+          src='fr', t='en', n_img=20, dedup_dist=None, n_workers=None,
+          k=None, filter_query=False, filter_lang=False, stop_words=None,
+          labels=None, fuzzy='fuzzywuzzy'):
+    # the target node and the nodes it needs
+    words = Node('words', words_stage, store=False,
+                 params=dict(file=file, start=start, stop=stop, query=query))
+    if target == 'words':
+        return words
+
+    def per_word(word):
+        node = Node('urls', urls_stage, params=dict(word=word, lang=t))
+        if target == 'urls':
+            return node
+        node = Node('dedup', dedup_stage, [node],
+                    params=dict(dist=dedup_dist))
+        if target == 'dedup':
+            return node
+        return Node('captions',
+                    partial(captions_stage, dag, n_workers=n_workers),
+                    [node], store=False,
+                    params=dict(word=word, lang=t, n_img=n_img))
+
+    nodes = [per_word(w) for w in dag.get(words)]
+    if target in ('urls', 'dedup', 'captions'):
+        return Node('all_' + target, lambda *vs: list(vs), nodes,
+                    store=False)
+
+    node = Node('predictions', predictions_stage, [words] + nodes,
+                params=dict(k=k, t=t, query=filter_query, lang=filter_lang,
+                            stop=stop_words, fuzzy=fuzzy))
+    if target == 'predictions':
+        return node
+
+    labels = Node('labels', labels_stage, store=False,
+                  params=dict(path=labels))
+    return Node('scores', scores_stage, [node, labels],
+                params=dict(src=src, t=t))
+
+
+def run(dag, target, **kw):
+    start = time.time()
+    value = dag.get(build(dag, target, **kw))
+    LOGGER.info('DAG %s in %.1fs: %s' % (target, time.time() - start,
+                                        dag.report()))
+    return value
+
+
+if __name__ == '__main__':
+    opts = parse_args(
+        arg('-target', choices=STAGES, default='predictions'),
+        arg('-store',  default=os.path.join('.cache', 'dag.sqlite')),
+        # stages to recompute even when stored, e.g. urls
+        arg('-refresh', nargs='*', choices=STAGES, default=()),
+        arg('-o', '--out'),
+
+        arg('-f', '--file'),
+        arg('-i', '--start', type=int),
+        arg('-j', '--stop',  type=int),
+        arg('-q', '--query', nargs='*'),
+        arg('-s', '--src',    default='fr'),
+        arg('-t', '--target-lang', default='en'),
+
+        arg('-n', '--n-img',  type=int, default=20),
+        arg('-dedup-dist',    type=int),
+        arg('-w', '--n-workers', type=int),
+
+        # filter_predictions.predict
+        arg('-k',             type=int),
+        arg('-filter-query',  action='store_true'),
+        arg('-filter-lang',   action='store_true'),
+        arg('-stop-words',    choices=('nltk', 'alt')),
+        # see filter_predictions.FUZZY_ENGINES
+        arg('-fuzzy',         choices=('fuzzywuzzy', 'rapidfuzz'),
+            default='fuzzywuzzy'),
+
+        arg('-labels'),
+    )
+    init_logging(stdout=True)
+    if opts.target == 'scores' and not is_(opts.labels):
+        raise SystemExit('-target scores needs -labels')
+
+    store = NodeStore(opts.store)
+    try:
+        value = run(DAG(store, opts.refresh), opts.target,
+                    file=opts.file, start=opts.start, stop=opts.stop,
+                    query=opts.query, src=opts.src, t=opts.target_lang,
+                    n_img=opts.n_img, dedup_dist=opts.dedup_dist,
+                    n_workers=opts.n_workers, k=opts.k,
+                    filter_query=opts.filter_query,
+                    filter_lang=opts.filter_lang,
+                    stop_words=opts.stop_words, labels=opts.labels,
+                    fuzzy=opts.fuzzy)
+        if opts.out:
+            with open(opts.out, 'w') as io:
+                json.dump(value, io)
+        else:
+            print(json.dumps(value))
+    finally:
+        store.close()
@@ -1,15 +1,22 @@
 import random
+import threading
 
 import traceback as tb
 import itertools as it
 
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, deque
 
 import numpy as np
 
 from sklearn.feature_extraction.text import TfidfVectorizer
 from fuzzywuzzy.fuzz import partial_ratio
 
+try:
+    from rapidfuzz.process import cdist
+    from rapidfuzz.fuzz import partial_ratio as rf_partial_ratio
+except ImportError:
+    cdist = None
+
 from nlp_utils import (
     clean,
     ngrams,
@@ -40,8 +47,8 @@ def top_counts(iterable):
     return list(tops)
 
 
-def filter_preds(preds, query=None, lang=None,
-                 phrase_type=None, final=None):
+def filtered_preds(preds, query=None, lang=None, phrase_type=None):
+    # -> (cleaned preds, the candidates counted from them)
     preds = list(map(clean, preds))
 
     if query:
@@ -60,6 +67,13 @@ def filter_preds(preds, query=None, lang=None,
     if lang:
         preds_filtr = filter(is_lang(lang,), preds_filtr)
 
+    return preds, preds_filtr
+
+
+def filter_preds(preds, query=None, lang=None,
+                 phrase_type=None, final=None):
+    preds, preds_filtr = filtered_preds(preds, query, lang, phrase_type)
+
     try:
         if preds_filtr:
             tops = top_counts(preds_filtr)
@@ -74,6 +88,47 @@ def filter_preds(preds, query=None, lang=None,
         LOGGER.error(tb.format_exc())
 
 
+### early stopping
+
+class EarlyStop(object):
+    """
+    counts a word's candidates as filter_preds does, one caption at a
+    time, and calls the race once the leader can't be caught: it leads
+    the runner-up by more than the captions left, or by z standard
+    deviations of an even race between the two (a sign test)
+    """
+    def __init__(self, query=None, lang=None, phrase_type='fragment',
+                 z=2., min_preds=4):
+        self.query = query
+        self.lang = lang
+        self.phrase_type = phrase_type
+        self.z = z
+        self.min_preds = min_preds
+        self.counts = Counter()
+        self.n_preds = 0
+        self.n_saved = 0
+
+    def add(self, pred):
+        _, preds_filtr = filtered_preds([pred], self.query, self.lang,
+                                        self.phrase_type)
+        self.counts.update(preds_filtr)
+        self.n_preds += 1
+
+    def leaders(self):
+        # [(candidate, count)] for the top two
+        return self.counts.most_common(2)
+
+    def converged(self, n_left):
+        if self.n_preds < self.min_preds or not self.counts:
+            return False
+        top = self.leaders()
+        a, b = top[0][1], top[1][1] if len(top) > 1 else 0
+        return a - b > n_left or a - b >= self.z * np.sqrt(a + b)
+
+    def __repr__(self):
+        return '<%s preds, leaders %s>' % (self.n_preds, self.leaders())
+
+
 def oracle(word_preds, labels, pos_counts, src='en', t='fr'):
     n_words, score = len(word_preds), 0
     pos_scores = defaultdict(float)
@@ -104,31 +159,67 @@ def scorer(preds, labels, pos_counts, src='en', t='fr', verbose=0, oracle=None):
                              for pos in pos_counts}
 
 
+def feature_names(vectorizer):
+    # get_feature_names went away in scikit-learn 1.2
+    get = getattr(vectorizer, 'get_feature_names_out', None) \
+        or vectorizer.get_feature_names
+    return list(get())
+
+
+def row_dicts(matrix, names, keep=None):
+    # {feature: score} of each row's nonzeros, straight from the csr arrays
+    indptr, indices, data = matrix.indptr, matrix.indices, matrix.data
+    rows = []
+    for i in range(matrix.shape[0]):
+        lo, hi = indptr[i], indptr[i+1]
+        rows.append({names[j]: score
+                     for j, score in zip(indices[lo:hi].tolist(),
+                                         data[lo:hi].tolist())
+                     if score > 0 and (keep is None or keep[j])})
+    return rows
+
+
+def normalize_by_length(matrix, lengths, ngram_lens):
+    # l2-normalizes each row within each n-gram length, in place, as if
+    # every length had been fit on its own
+    squares = matrix.multiply(matrix).tocsr()
+    norms = np.column_stack([
+        np.sqrt(np.asarray(squares.dot((lengths == n).astype(float))))
+        .ravel() for n in ngram_lens])
+    norms[norms == 0] = 1.
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    col = np.searchsorted(ngram_lens, lengths[matrix.indices])
+    matrix.data /= norms[rows, col]
+    return matrix
+
+
 def tfidf_word_feats(word_matrix, ngrams=(2,)):
+    """
+    per src word, (tfidf of each pred word, tfidf of each char n-gram
+    over all lengths in `ngrams`); kept sparse throughout, so memory
+    goes with the nonzeros
+    """
     docs_by_word = [' '.join(pred_list) for pred_list in word_matrix]
 
     # by individual word
-    tfidf_word_results = []
-    tfidf_wrd = TfidfVectorizer(tokenizer=tokenize())
-    word_scores = tfidf_wrd.fit_transform(docs_by_word).toarray()
-    word_feat_names = tfidf_wrd.get_feature_names()
-    for i, row in enumerate(word_scores):
-        tfidf_word_results.append({pred_name: score
-             for score, pred_name in zip(row, word_feat_names)
-             if score > 0})
-
-    # by n-gram, for multiple n
-    tfidf_ng_results = []
-
-    # FIXME need to merge dicts over all n
-    for n in ngrams:
-        tfidf_char = TfidfVectorizer(analyzer='char', ngram_range=(n, n))
-        char_scores = tfidf_char.fit_transform(docs_by_word).toarray()
-        char_feat_names = tfidf_char.get_feature_names()
-        for i, row in enumerate(char_scores):
-            tfidf_ng_results.append({ng: score
-                for score, ng in zip(row, char_feat_names)
-                if score > 0 and ' ' not in ng})
+    tfidf_wrd = TfidfVectorizer(tokenizer=tokenize(), token_pattern=None)
+    word_scores = tfidf_wrd.fit_transform(docs_by_word).tocsr()
+    tfidf_word_results = row_dicts(word_scores, feature_names(tfidf_wrd))
+
+    # by n-gram: one fit over all lengths, normalized per length
+    ngram_lens = np.array(sorted(set(ngrams)))
+    single = len(ngram_lens) == 1
+    tfidf_char = TfidfVectorizer(analyzer='char',
+                                 ngram_range=(ngram_lens[0], ngram_lens[-1]),
+                                 norm='l2' if single else None)
+    char_scores = tfidf_char.fit_transform(docs_by_word).tocsr()
+    char_feat_names = feature_names(tfidf_char)
+    lengths = np.array([len(ng) for ng in char_feat_names])
+    if not single:
+        char_scores = normalize_by_length(char_scores, lengths, ngram_lens)
+    keep = np.isin(lengths, ngram_lens) & \
+        np.array([' ' not in ng for ng in char_feat_names], dtype=bool)
+    tfidf_ng_results = row_dicts(char_scores, char_feat_names, keep)
 
     return list(zip(tfidf_word_results, tfidf_ng_results))
 
@@ -147,8 +238,129 @@ def normalize_dict(d):
     return {k: normalizer(d[k]) for k in d}
 
 
+### fuzziness
+
+# 'fuzzywuzzy' gives the scores predictions have always had. 'rapidfuzz'
+# scores the matrix in one cdist call, far faster on long rows, but its
+# partial_ratio takes the optimal alignment where fuzzywuzzy's takes
+# difflib's blocks: scores move by up to ~14 points and the top fuzzy word
+# of about a third of the saved words changes, so it must be asked for
+FUZZY_ENGINES = 'fuzzywuzzy', 'rapidfuzz'
+
+# from this many unique words, pairs sharing no character are scored 0
+# without comparing them; partial_ratio is 0 for those anyway
+FUZZY_BLOCK_MIN = 5000
+
+
+def fuzzy_matrix(words, engine='fuzzywuzzy', block_min=FUZZY_BLOCK_MIN):
+    # partial_ratio(words[i], words[j]) by engine, see FUZZY_ENGINES
+    if engine not in FUZZY_ENGINES:
+        raise ValueError('unknown fuzzy engine %r' % engine)
+    if engine == 'rapidfuzz' and cdist is None:
+        raise ImportError('fuzzy engine rapidfuzz is not installed')
+
+    def scores(a, bs):
+        if engine == 'rapidfuzz':
+            return cdist([a], bs, scorer=rf_partial_ratio)[0]
+        return [partial_ratio(a, b) for b in bs]
+
+    m = len(words)
+    if m < block_min:
+        if engine == 'rapidfuzz':
+            return np.rint(cdist(words, words, scorer=rf_partial_ratio,
+                                 workers=-1))
+        return np.array([scores(a, words) for a in words], dtype=float)
+    index = defaultdict(set)
+    for j, w in enumerate(words):
+        for ch in w:
+            index[ch].add(j)
+    matrix = np.zeros((m, m))
+    for i, w in enumerate(words):
+        js = sorted(set().union(*(index[ch] for ch in set(w))))
+        matrix[i, js] = scores(w, [words[j] for j in js])
+    return np.rint(matrix)
+
+
+def fuzzy_scores(deduped, counts, **kw):
+    """
+    mean partial_ratio of each word with every other token occurrence,
+    from one matrix over the unique words weighted by their counts: the
+    word's own slot is left out, its other occurrences score 100
+    """
+    n = sum(counts.values())
+    if n < 2:
+        return {w: np.nan for w in deduped}
+    matrix = fuzzy_matrix(deduped, **kw)
+    weights = np.array([counts[w] for w in deduped], dtype=float)
+    means = (matrix.dot(weights) - np.diag(matrix)) / (n - 1)
+    return dict(zip(deduped, means))
+
+
+### substrings
+
+class AhoCorasick(object):
+    """
+    automaton over a set of patterns: which of them occur in a text, in
+    one pass over it
+    """
+    def __init__(self, patterns):
+        self.goto, self.fail, self.out = [{}], [0], [[]]
+        for k, pattern in enumerate(patterns):
+            s = 0
+            for ch in pattern:
+                t = self.goto[s].get(ch)
+                if t is None:
+                    t = self.goto[s][ch] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                s = t
+            self.out[s].append(k)
+        # breadth first, so a state's fail state is done before it
+        queue = deque(self.goto[0].values())
+        while queue:
+            s = queue.popleft()
+            for ch, t in self.goto[s].items():
+                queue.append(t)
+                f = self.fail[s]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[t] = self.goto[f].get(ch, 0)
+                self.out[t] = self.out[t] + self.out[self.fail[t]]
+
+    def matches(self, text):
+        # ids of the patterns in text
+        s, found = 0, set()
+        for ch in text:
+            while s and ch not in self.goto[s]:
+                s = self.fail[s]
+            s = self.goto[s].get(ch, 0)
+            found.update(self.out[s])
+        return found
+
+
+def substring_scores(deduped, counts):
+    """
+    share of the other token occurrences each word is a substring of:
+    each unique word is scanned once for all the others, and counts for
+    as many occurrences as it has (minus the word's own slot)
+    """
+    n = sum(counts.values())
+    if n < 2:
+        return {w: np.nan for w in deduped}
+    automaton = AhoCorasick(deduped)
+    totals = np.zeros(len(deduped))
+    for w in deduped:
+        for k in automaton.matches(w):
+            totals[k] += counts[w]
+    return dict(zip(deduped, (totals - 1) / (n - 1)))
+
+
 def word_row_feats(word, words_w_ranks, lang, ngram_lens=(2,),
-                   tfidf_words=None, tfidf_ngrams=None):
+                   tfidf_words=None, tfidf_ngrams=None, with_score=False,
+                   fuzzy='fuzzywuzzy'):
+    # with_score: (pred, its mean score, its margin over the runner-up)
+    # fuzzy: partial_ratio's engine, see FUZZY_ENGINES
     if not tfidf_words:  tfidf_words  = defaultdict(lambda:1)
     if not tfidf_ngrams: tfidf_ngrams = defaultdict(lambda:1)
 
@@ -170,34 +382,20 @@ def word_row_feats(word, words_w_ranks, lang, ngram_lens=(2,),
     stem_counts = {w: stem_counter[stems[w]] for w in deduped}
 
     # ngrams
-    ngram_counts = defaultdict(float)
+    ngram_counts = {}
     for n in ngram_lens:
         word_ngrams = {word: list(ngrams(word, n)) for word in deduped}
         ngram_counter = Counter(ng for w in words for ng in word_ngrams[w])
-        for w in deduped:
-            # max?
-            ngram_counts[n, w] = np.mean([ngram_counter[ng] * tfidf_ngrams[ng]
-                                          for ng in word_ngrams[w]])
+        # max?
+        ngram_counts[n] = {w: np.mean([ngram_counter[ng] * tfidf_ngrams[ng]
+                                       for ng in word_ngrams[w]])
+                           for w in deduped}
 
     # fuzziness
-    seen = set()
-    fuzzy_score = {}
-    for i in range(len(words)):
-        wi = words[i]
-        if wi not in seen:
-            seen.add(wi)
-            fuzzy_score[wi] = np.mean([partial_ratio(wi, words[j])
-                                      for j in range(len(words)) if j != i])
+    fuzzy_score = fuzzy_scores(deduped, counts, engine=fuzzy)
 
     # substrings
-    seen = set()
-    substring_score = {}
-    for i in range(len(words)):
-        wi = words[i]
-        if wi not in seen:
-            seen.add(wi)
-            substring_score[wi] = np.mean([
-                wi in words[j] for j in range(len(words)) if j != i])
+    substring_score = substring_scores(deduped, counts)
 
     score_dicts = list(map(normalize_dict,
         [ngram_counts[n] for n in ngram_lens] +
@@ -208,13 +406,35 @@ def word_row_feats(word, words_w_ranks, lang, ngram_lens=(2,),
                       for dct in score_dicts) for w in deduped}
 
     # weighted mean? or keep as tuple? or use as feat vectors?
-    s, W = max([(np.mean(v),w) for w,v in scores.items()])
+    ranked = sorted([(np.mean(v),w) for w,v in scores.items()], reverse=True)
+    s, W = ranked[0]
+    if with_score:
+        return W, s, s - ranked[1][0] if len(ranked) > 1 else s
     return W
 
 
+def clean_preds(word, preds, stop_words=(), k=None,
+                t='fr', query=False, lang=False):
+    preds = list(
+        filter(has_letter,
+               map(clean, preds[:k])))
+
+    if stop_words:
+        preds = [w for w in preds if w not in stop_words]
+
+    if query: # filter src word
+        clean_q = clean(word)
+        preds = [p for p in preds if p != clean_q]
+
+    if lang: # filter by target language
+        preds = list(filter(is_lang(t), preds))
+
+    return preds
+
+
 def predict(word_preds, stop_words=(), k=None,
             t='fr', query=False, lang=False,
-            save_pred=None, load_pred=None):
+            save_pred=None, load_pred=None, fuzzy='fuzzywuzzy'):
 
     if load_pred:
         word_preds = load(load_pred)
@@ -223,21 +443,8 @@ def predict(word_preds, stop_words=(), k=None,
         word_preds = list(map(list, word_preds))
 
         for i in range(len(word_preds)):
-            preds = list(
-                filter(has_letter,
-                       map(clean, word_preds[i][1][:k])))
-
-            if stop_words:
-                preds = [w for w in preds if w not in stop_words]
-
-            if query: # filter src word
-                clean_q = clean(word_preds[i][0])
-                preds = [p for p in preds if p != clean_q]
-
-            if lang: # filter by target language
-                preds = list(filter(is_lang(t), preds))
-
-            word_preds[i][1] = preds
+            word_preds[i][1] = clean_preds(*word_preds[i], stop_words, k,
+                                           t, query, lang)
 
     if save_pred:
         dump(word_preds, save_pred)
@@ -251,9 +458,102 @@ def predict(word_preds, stop_words=(), k=None,
     for (wrd, wrd_pred), (tfidf_words, tfidf_ngs) in \
             zip(word_preds, tfidf_results):
         words_w_ranks = list(preds_to_words(wrd_pred, stop_words, rank=True))
+        if not words_w_ranks:  # no captions left, e.g. all searches failed
+            yield None
+            continue
         yield word_row_feats(wrd, words_w_ranks, t,
                              tfidf_words=tfidf_words,
                              tfidf_ngrams=tfidf_ngs,
+                             fuzzy=fuzzy,
                              )
 
 
+
+
+### streaming
+
+class StreamingTfidf(object):
+    """
+    tfidf_word_feats for words arriving one at a time: document
+    frequencies grow with each word, instead of refitting on all of
+    them. same weights as a TfidfVectorizer fit on the words so far
+    (smooth idf, l2 rows, char n-grams of the joined doc)
+    """
+    def __init__(self, ngram_lens=(2,)):
+        self.ngram_lens = ngram_lens
+        self.n_docs = 0
+        self.df_words = Counter()
+        self.df_ngrams = {n: Counter() for n in ngram_lens}
+
+    def char_ngrams(self, doc, n):
+        doc = ' '.join(doc.split())
+        return Counter(doc[i:i+n] for i in range(len(doc)-n+1))
+
+    def add(self, pred_words):
+        # -> term counts for this word's doc
+        doc = ' '.join(pred_words).lower()
+        tf_words = Counter(tokenize()(doc)) if doc else Counter()
+        tf_ngrams = {n: self.char_ngrams(doc, n) for n in self.ngram_lens}
+        self.n_docs += 1
+        self.df_words.update(tf_words.keys())
+        for n in self.ngram_lens:
+            self.df_ngrams[n].update(tf_ngrams[n].keys())
+        return tf_words, tf_ngrams
+
+    def weights(self, tf, df):
+        w = {t: c * (np.log((1. + self.n_docs) / (1. + df[t])) + 1.)
+             for t, c in tf.items()}
+        norm = np.sqrt(sum(v * v for v in w.values())) or 1.
+        return {t: v / norm for t, v in w.items()}
+
+    def scores(self, tf_words, tf_ngrams):
+        # (word scores, n-gram scores over all n) as tfidf_word_feats
+        ngram_scores = {}
+        for n in self.ngram_lens:
+            ngram_scores.update(
+                (ng, v) for ng, v in
+                self.weights(tf_ngrams[n], self.df_ngrams[n]).items()
+                if ' ' not in ng)
+        return self.weights(tf_words, self.df_words), ngram_scores
+
+
+class StreamingPredictor(object):
+    """
+    predict() one word at a time, as its captions arrive
+    """
+    def __init__(self, stop_words=(), k=None, t='fr', query=False,
+                 lang=False, ngram_lens=(2,), fuzzy='fuzzywuzzy'):
+        self.stop_words = stop_words
+        self.k = k
+        self.t = t
+        self.query = query
+        self.lang = lang
+        self.ngram_lens = ngram_lens
+        self.fuzzy = fuzzy
+        self.tfidf = StreamingTfidf(ngram_lens)
+        self.lock = threading.Lock()
+
+    def words(self, word, preds):
+        preds = clean_preds(word, preds, self.stop_words, self.k, self.t,
+                            self.query, self.lang)
+        return list(preds_to_words(preds, self.stop_words, rank=True))
+
+    def prime(self, word_preds):
+        # document frequencies from words predicted earlier
+        with self.lock:
+            for word, preds in word_preds:
+                self.tfidf.add([w for w, _ in self.words(word, preds)])
+
+    def predict(self, word, preds):
+        # -> (pred, score, margin) or None without any candidate
+        words_w_ranks = self.words(word, preds)
+        with self.lock:
+            tf_words, tf_ngrams = self.tfidf.add(
+                [w for w, _ in words_w_ranks])
+            tfidf_words, tfidf_ngs = self.tfidf.scores(tf_words, tf_ngrams)
+        if not words_w_ranks:
+            return
+        return word_row_feats(word, words_w_ranks, self.t, self.ngram_lens,
+                              tfidf_words=tfidf_words,
+                              tfidf_ngrams=tfidf_ngs, with_score=True,
+                              fuzzy=self.fuzzy)
@@ -0,0 +1,142 @@
+"""
+targeted extraction from google result pages without building a full
+tree; each extractor returns None when the page doesn't look as
+expected, so callers can fall back to BeautifulSoup
+"""
+
+import re
+import html
+
+from html.parser import HTMLParser
+
+import ujson as json
+
+
+### image search: rg_meta divs
+
+RG_META = re.compile(r'<div[^>]*\bclass="(?:[^"]*\s)?rg_meta(?:\s[^"]*)?"'
+                     r'[^>]*>(.*?)</div>', re.S)
+
+
+def extract_imgs(text):
+    # [(url, type)] from the json in each rg_meta div
+    imgs = []
+    for m in RG_META.finditer(text):
+        try:
+            d = json.loads(html.unescape(m.group(1)))
+            imgs.append((d['ou'], d['ity']))
+        except (ValueError, KeyError):
+            return
+    return imgs or None
+
+
+### reverse search: first card-section
+
+VOID_TAGS = frozenset({'area', 'base', 'br', 'col', 'embed', 'hr', 'img',
+                       'input', 'link', 'meta', 'param', 'source', 'track',
+                       'wbr'})
+
+
+class Found(Exception):
+    pass
+
+
+class NotFound(Exception):
+    pass
+
+
+class CardParser(HTMLParser):
+    """
+    text of the first <a> in the 2nd child node of the first
+    div.card-section, i.e. bs4's `card.next.nextSibling.a.text`;
+    stops parsing as soon as it has it
+    """
+    def __init__(self):
+        super().__init__()
+        self.in_card = False
+        self.depth = 0          # below the card
+        self.n_children = 0
+        self.last_was_text = False
+        self.in_target = False  # inside the card's 2nd child
+        self.a_depth = None
+        self.text = []
+
+    def child(self, is_text):
+        # a new direct child of the card, merging adjacent text
+        if is_text and self.last_was_text:
+            return
+        self.n_children += 1
+        self.last_was_text = is_text
+        if self.n_children == 2 and is_text:
+            raise NotFound('text node')
+        self.in_target = self.n_children == 2
+
+    def handle_starttag(self, tag, attrs):
+        if not self.in_card:
+            classes = (dict(attrs).get('class') or '').split()
+            if tag == 'div' and 'card-section' in classes:
+                self.in_card = True
+                return
+            raise NotFound('not at a card-section')
+        if self.depth == 0:
+            if self.n_children >= 2:
+                raise NotFound('no <a> in 2nd child')
+            self.child(False)
+        if self.in_target and tag == 'a' and self.a_depth is None:
+            self.a_depth = self.depth
+        if tag not in VOID_TAGS:
+            self.depth += 1
+
+    def handle_startendtag(self, tag, attrs):
+        if self.in_card and self.depth == 0:
+            if self.n_children >= 2:
+                raise NotFound('no <a> in 2nd child')
+            self.child(False)
+
+    def handle_endtag(self, tag):
+        if not self.in_card or tag in VOID_TAGS:
+            return
+        if self.depth == 0:
+            raise NotFound('card ended')
+        self.depth -= 1
+        if self.a_depth is not None and self.depth == self.a_depth \
+                and tag == 'a':
+            raise Found
+        if self.depth == 0 and self.in_target:
+            raise NotFound('no <a> in 2nd child')
+
+    def handle_data(self, data):
+        if not self.in_card:
+            return
+        if self.depth == 0:
+            if self.n_children >= 2:
+                raise NotFound('no <a> in 2nd child')
+            self.child(True)
+        elif self.a_depth is not None:
+            self.text.append(data)
+
+    def handle_comment(self, data):
+        if self.in_card and self.depth == 0:
+            self.child(True)
+
+
+CARD_CLASS = re.compile(r'class="(?:[^"]*\s)?card-section(?:\s[^"]*)?"')
+
+
+def extract_card_text(text, chunk_size=8192):
+    for m in CARD_CLASS.finditer(text):
+        start = text.rfind('<', 0, m.start())
+        if start < 0:
+            continue
+        parser = CardParser()
+        try:
+            for i in range(start, len(text), chunk_size):
+                parser.feed(text[i:i+chunk_size])
+        except Found:
+            return ''.join(parser.text)
+        except NotFound:
+            if parser.in_card:
+                # bs4 would have taken this card and failed too
+                return
+        else:
+            return
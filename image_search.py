@@ -1,16 +1,20 @@
 import os
 import uuid
 
+import itertools as it
 import traceback as tb
 
+from concurrent.futures import ThreadPoolExecutor
+
 import ujson as json
 
-from PIL import Image
 from bs4 import BeautifulSoup
 
-from web import request
-from utils import is_, get_logger
+from web import request, count_bytes, record, recording, BadStatusCode
+from utils import is_, get_logger, Lazy
 from nlp_utils import lang_params
+from image_utils import strip_metadata, phash, hamming
+from html_extract import extract_imgs
 
 
 LOGGER = get_logger(__name__)
@@ -26,47 +30,187 @@ def get_imgs_from_soup(soup):
     return [(d['ou'], d['ity']) for d in metadata]
 
 
+def parse_imgs(resp):
+    imgs = extract_imgs(resp.text)
+    if imgs is None:
+        soup = BeautifulSoup(resp.text, 'lxml')
+        imgs = get_imgs_from_soup(soup)
+    return imgs
+
+
+def has_imgs(resp):
+    # only these pages are cached, not captchas or empty results
+    try:
+        return bool(parse_imgs(resp))
+    except Exception:
+        return False
+
+
 def get_imgs(query, lang=None, debug=None):
     query_url = QUERY_URL(query)
     if is_(lang):
         query_url += '&' + lang_params(lang)
     if debug:
         print('query_url for %s: %s' % (query, query_url))
-    resp  = request(query_url, sleep=(.5, 1.5))
-    soup  = BeautifulSoup(resp.text, 'lxml')
-    return get_imgs_from_soup(soup)
+    resp  = request(query_url, sleep=(.5, 1.5), cached=True, valid=has_imgs)
+    return parse_imgs(resp)
+
+
+### download
+
+N_DOWNLOAD_WORKERS = 8
+CHUNK_SIZE = 64 * 1024
+MAX_IMG_BYTES = 20 * 1024 ** 2
+
+# servers often send images as octet-stream
+IMG_CONTENT_TYPES = 'image/', 'application/octet-stream', 'binary/octet-stream'
 
 
-def save_img(url, img_type, save_dir, rm_meta=False):
-    raw_img   = request(url, sleep=(.5, 1.5)).content
+class BadImage(Exception):
+    pass
+
+
+def check_headers(resp, max_bytes=MAX_IMG_BYTES):
+    if resp.status_code != 200:
+        raise BadStatusCode(resp.status_code)
+    ctype = resp.headers.get('Content-Type', '').lower()
+    if ctype and not ctype.startswith(IMG_CONTENT_TYPES):
+        raise BadImage('content type %s' % ctype)
+    length = int(resp.headers.get('Content-Length') or 0)
+    if length > max_bytes:
+        raise BadImage('%s bytes > %s' % (length, max_bytes))
+
+
+def save_img(url, img_type, save_dir, rm_meta=False,
+             max_bytes=MAX_IMG_BYTES, chunk_size=CHUNK_SIZE):
     ext       = img_type or 'jpg'
     name      = str(uuid.uuid4().hex) + '.' + ext
     save_path = os.path.join(save_dir, name)
-    with open(save_path, 'wb+') as f:
-        f.write(raw_img)
-    if rm_meta:
-        Image.open(save_path).save(save_path)
-
-
-def save_imgs(imgs, save_dir, n_img=float('inf')):
-    for i, (url, img_type) in enumerate(imgs):
-        if i >= n_img:
-            break
+    part_path = save_path + '.part'
+    resp = request(url, sleep=(.5, 1.5), stream=True)
+    size = 0
+    try:
+        check_headers(resp, max_bytes)
+        with open(part_path, 'wb+') as f:
+            for chunk in resp.iter_content(chunk_size):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise BadImage('> %s bytes' % max_bytes)
+                f.write(chunk)
+        if recording():
+            with open(part_path, 'rb') as f:
+                record(url, resp, f.read())
+        if rm_meta:
+            strip_metadata(part_path)
+        os.replace(part_path, save_path)
+    except:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    finally:
+        count_bytes(url, size)
+        resp.close()
+    return save_path
+
+
+def save_imgs(imgs, save_dir, n_img=float('inf'), rm_meta=False,
+              n_workers=N_DOWNLOAD_WORKERS):
+    # paths in image order, None for failed downloads
+    imgs = list(it.islice(imgs, None if n_img == float('inf') else n_img))
+    with ThreadPoolExecutor(n_workers) as executor:
+        futures = [executor.submit(save_img, url, img_type, save_dir, rm_meta)
+                   for url, img_type in imgs]
+    paths = []
+    for (url, _), future in zip(imgs, futures):
         try:
-            save_img(url, img_type, save_dir)
+            paths.append(future.result())
         except:
-            LOGGER.error(tb.format_exc())
-
-
-def image_search(query, lang=None, save=None, debug=None):
-    LOGGER.info('START (Phase 1) Getting Image URLs for: %s' % query)
+            LOGGER.error('Image download failed: %s\n%s'
+                         % (url, tb.format_exc()))
+            paths.append(None)
+    return paths
+
+
+### dedup
+
+# max hamming distance between the phashes of near-duplicate images
+DEDUP_DIST = 6
+
+
+def fetch_img(url, max_bytes=MAX_IMG_BYTES, chunk_size=CHUNK_SIZE):
+    resp = request(url, stream=True)
+    chunks, size = [], 0
+    try:
+        check_headers(resp, max_bytes)
+        for chunk in resp.iter_content(chunk_size):
+            size += len(chunk)
+            if size > max_bytes:
+                raise BadImage('> %s bytes' % max_bytes)
+            chunks.append(chunk)
+        data = b''.join(chunks)
+        record(url, resp, data)
+        return data
+    finally:
+        count_bytes(url, size)
+        resp.close()
+
+
+def img_hash(url, path=None):
+    try:
+        if path:
+            with open(path, 'rb') as f:
+                data = f.read()
+        else:
+            data = fetch_img(url)
+        return phash(data)
+    except:
+        LOGGER.warning('Could not hash image: %s\n%s'
+                       % (url, tb.format_exc()))
+
+
+def dedupe_urls(urls, max_dist=DEDUP_DIST, paths=None, n_keep=None,
+                n_workers=N_DOWNLOAD_WORKERS):
+    """
+    drop images within max_dist of an earlier image's phash, keeping
+    google's order; saved images are hashed from `paths`, the rest are
+    fetched. stops hashing once n_keep distinct images are found, the
+    remaining urls are kept as they are. unhashable images are kept
+    """
+    urls = list(urls)
+    paths = list(paths) if paths else [None] * len(urls)
+    kept, hashes, n_dups, i = [], [], 0, 0
+    with ThreadPoolExecutor(n_workers) as executor:
+        while i < len(urls) and (n_keep is None or len(kept) < n_keep):
+            batch = range(i, min(len(urls), i + n_workers))
+            for j, h in zip(batch, executor.map(
+                    lambda j: img_hash(urls[j], paths[j]), batch)):
+                if h is not None and any(hamming(h, h2) <= max_dist
+                                         for h2 in hashes):
+                    n_dups += 1
+                    LOGGER.info('Dropping near-duplicate image #%s: %s',
+                                j, urls[j])
+                    continue
+                if h is not None:
+                    hashes.append(h)
+                kept.append(urls[j])
+            i = batch.stop
+    LOGGER.info('Dedup: kept %s, dropped %s near-duplicates, %s unhashed',
+                len(kept), n_dups, len(urls) - i)
+    return kept + urls[i:]
+
+
+def numbered(lines):
+    return '\n' + ''.join('%s: %s\n' % (i+1, line)
+                          for i, line in enumerate(lines))
+
+
+def image_search(query, lang=None, save=None, debug=None,
+                 with_paths=False):
+    LOGGER.info('START (Phase 1) Getting Image URLs for: %s', query)
     query = query.strip().replace(' ', '+')
     images = get_imgs(query, lang, debug)
-    if save:
-        save_imgs(images, save)
+    paths = save_imgs(images, save) if save else None
     urls, _ = zip(*images)
-    paths_str = '\n' + ''.join('%s: %s\n' % (i+1, path)
-                               for i, path in enumerate(urls))
-    LOGGER.info('DONE (Phase 1) Getting Image URLs for: %s\n- URLs -%s'
-                % (query, paths_str))
-    return urls
\ No newline at end of file
+    LOGGER.info('DONE (Phase 1) Getting Image URLs for: %s\n- URLs -%s',
+                query, Lazy(numbered, urls))
+    return (urls, paths) if with_paths else urls
\ No newline at end of file
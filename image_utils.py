@@ -0,0 +1,137 @@
+"""
+image byte helpers: type sniffing, metadata stripping without decoding,
+perceptual hashing
+"""
+
+import io
+
+import numpy as np
+
+from utils import get_logger
+
+
+LOGGER = get_logger(__name__)
+
+
+### sniffing
+
+JPEG_SOI = b'\xff\xd8'
+PNG_SIG = b'\x89PNG\r\n\x1a\n'
+
+
+def sniff(data):
+    if data.startswith(JPEG_SOI):
+        return 'jpg'
+    if data.startswith(PNG_SIG):
+        return 'png'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    if data[:2] == b'BM':
+        return 'bmp'
+
+
+### metadata
+
+# APP1 (exif/xmp) .. APP13 (photoshop/iptc), APP15 and comments;
+# APP0 (jfif) and APP14 (adobe colour transform) are needed to decode
+JPEG_DROP = frozenset(range(0xe1, 0xee)) | {0xef, 0xfe}
+JPEG_SOS, JPEG_EOI = 0xda, 0xd9
+# markers without a length field
+JPEG_STANDALONE = frozenset(range(0xd0, 0xd8)) | {0x01}
+
+
+def strip_jpeg(data):
+    # copy segments up to the scan, dropping metadata ones; None if the
+    # marker structure doesn't parse
+    out, i = [JPEG_SOI], 2
+    while i + 4 <= len(data):
+        if data[i] != 0xff:
+            return
+        marker = data[i+1]
+        if marker == 0xff:  # fill byte
+            i += 1
+            continue
+        if marker in (JPEG_SOS, JPEG_EOI):
+            out.append(data[i:])
+            return b''.join(out)
+        if marker in JPEG_STANDALONE:
+            out.append(data[i:i+2])
+            i += 2
+            continue
+        end = i + 2 + int.from_bytes(data[i+2:i+4], 'big')
+        if marker not in JPEG_DROP:
+            out.append(data[i:end])
+        i = end
+
+
+PNG_DROP = frozenset({b'tEXt', b'zTXt', b'iTXt', b'eXIf', b'tIME'})
+
+
+def strip_png(data):
+    out, i = [PNG_SIG], len(PNG_SIG)
+    while i + 12 <= len(data):
+        length = int.from_bytes(data[i:i+4], 'big')
+        chunk_type, end = data[i+4:i+8], i + 12 + length
+        if chunk_type not in PNG_DROP:
+            out.append(data[i:end])
+        i = end
+        if chunk_type == b'IEND':
+            return b''.join(out)
+
+
+STRIPPERS = {'jpg': strip_jpeg, 'png': strip_png}
+
+
+def strip_metadata(path):
+    # byte-level for jpeg/png, full decode + re-encode otherwise
+    with open(path, 'rb') as f:
+        data = f.read()
+    stripper = STRIPPERS.get(sniff(data))
+    stripped = stripper(data) if stripper else None
+    if stripped is None:
+        from PIL import Image
+        img = Image.open(path)
+        img.save(path, img.format)
+    elif len(stripped) < len(data):
+        with open(path, 'wb') as f:
+            f.write(stripped)
+
+
+### perceptual hash
+
+PHASH_SIZE = 8
+PHASH_SCALE = 4
+
+
+def dct_matrix(n):
+    # orthonormal DCT-II: D @ x transforms the columns of x
+    k, i = np.mgrid[:n, :n]
+    d = np.cos(np.pi * (2 * i + 1) * k / (2. * n)) * np.sqrt(2. / n)
+    d[0] /= np.sqrt(2.)
+    return d
+
+
+_DCT = {}
+
+
+def phash(data, hash_size=PHASH_SIZE, scale=PHASH_SCALE):
+    # 64-bit pHash of image bytes: low frequencies of the 2d DCT of a
+    # 32x32 grayscale thumbnail, thresholded at their median
+    from PIL import Image
+    n = hash_size * scale
+    img = Image.open(io.BytesIO(data))
+    img.draft('L', (2 * n, 2 * n))  # jpeg: decode at reduced size
+    pixels = np.asarray(img.convert('L').resize((n, n), Image.LANCZOS),
+                        dtype=float)
+    if n not in _DCT:
+        _DCT[n] = dct_matrix(n)
+    d = _DCT[n]
+    low = (d @ pixels @ d.T)[:hash_size, :hash_size]
+    bits = (low > np.median(low)).flatten()
+    return int(''.join('1' if b else '0' for b in bits), 2)
+
+
+def hamming(h1, h2):
+    return bin(h1 ^ h2).count('1')
@@ -0,0 +1,90 @@
+"""
+append-only journal of a run's finished work, for resuming after a crash
+"""
+
+import os
+import threading
+
+from collections import defaultdict
+
+import ujson as json
+
+
+URLS, REVERSE, WORD_DONE = 'urls', 'reverse', 'word_done'
+
+
+class Journal(object):
+    # one json object per line, flushed and fsynced as it is written
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.io = open(path, 'a')
+
+    def append(self, kind, **record):
+        line = json.dumps({'kind': kind, **record})
+        with self.lock:
+            self.io.write(line + '\n')
+            self.io.flush()
+            os.fsync(self.io.fileno())
+
+    def urls(self, word, urls):
+        self.append(URLS, word=word, urls=list(urls))
+
+    def reverse(self, word, i, url, pred):
+        # pred None for a failed search, which a resumed run retries
+        self.append(REVERSE, word=word, i=i, url=url, pred=pred)
+
+    def word_done(self, word):
+        self.append(WORD_DONE, word=word)
+
+    def close(self):
+        with self.lock:
+            self.io.close()
+
+
+class JournalState(object):
+    def __init__(self):
+        self.urls = {}                       # word -> urls
+        self.reverse = defaultdict(dict)     # word -> {url: pred}
+        self.failed = defaultdict(set)       # word -> urls to search again
+        self.done = set()
+
+    def __repr__(self):
+        return '<%s words done, %s with urls, %s reverse searches,' \
+               ' %s to retry>' % (
+                   len(self.done), len(self.urls),
+                   sum(map(len, self.reverse.values())),
+                   sum(map(len, self.failed.values())))
+
+
+def load_journal(path):
+    state = JournalState()
+    if not os.path.exists(path):
+        return state
+    with open(path) as io:
+        for line in io:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue  # torn last line
+            kind, word = rec['kind'], rec['word']
+            if kind == URLS:
+                state.urls[word] = rec['urls']
+            elif kind == REVERSE:
+                url, pred = rec['url'], rec['pred']
+                if pred is None:
+                    state.reverse[word].pop(url, None)
+                    state.failed[word].add(url)
+                else:
+                    state.reverse[word][url] = pred
+                    state.failed[word].discard(url)
+            elif kind == WORD_DONE:
+                state.done.add(word)
+    # failed searches (a captcha, a timeout) aren't final: their words
+    # are redone, reusing the searches that did succeed
+    for word, urls in list(state.failed.items()):
+        if urls:
+            state.done.discard(word)
+        else:
+            del state.failed[word]
+    return state
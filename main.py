@@ -1,4 +1,12 @@
+import time
+
 import os.path as osp
+import traceback as tb
+
+from functools import partial
+from collections import defaultdict
+
+import ujson as json
 
 from utils import (
     is_,
@@ -7,13 +15,14 @@ from utils import (
     mkdir_p,
     time_stamp,
     init_logging,
+    stop_logging,
     get_logger,
     write_lines,
     read_lines,
 )
+from dag import STAGES
 
 
-# TODO only do parts of pipeline
 opts = parse_args(
     arg('-name', default='fr-clean'),
 
@@ -29,30 +38,137 @@ opts = parse_args(
 
     arg('-n', '--n-img',  type=int, default=20),
 
+    # concurrent reverse search (serial if not given)
+    arg('-w', '--n-workers',  type=int),
+    arg('-pp', '--per-proxy', type=int, default=2),
+
+    # overlap words: Phase 1 and Phase 2 as stages with their own workers
+    arg('-pipeline',              action='store_true'),
+    arg('-sw', '--search-workers',  type=int, default=1),
+    arg('-rw', '--reverse-workers', type=int, default=2),
+    arg('-qs', '--queue-size',      type=int, default=4),
+    arg('-report-every',            type=float, default=60.),
+
     # pipeline
     arg('-is', '--sch',   action='store_true'),
     arg('-rs', '--rsch',  action='store_true'),
+    # predict each word as its captions arrive, into <word>/prediction.txt
     arg('-pred',          action='store_true'),
+    arg('-pred-k',        type=int),
+    # run dirs whose preds.txt seed the tf-idf document frequencies
+    arg('-pred-prime',    nargs='*', default=()),
+    # rapidfuzz is faster but changes the fuzziness scores (and some
+    # predictions), see filter_predictions.FUZZY_ENGINES
+    arg('-fuzzy',         choices=('fuzzywuzzy', 'rapidfuzz'),
+        default='fuzzywuzzy'),
+    # keep the images found in Phase 1 under <word>/imgs
+    arg('-save-imgs',     action='store_true'),
+    # drop near-duplicate images before reverse search
+    arg('-dedup',         action='store_true'),
+    arg('-dedup-dist',    type=int, default=6),
+    # stop reverse searching a word once its leader is this many standard
+    # deviations ahead (see filter_predictions.EarlyStop)
+    arg('-early-stop',    type=float, metavar='Z'),
+    arg('-early-min',     type=int, default=4),
 
     # use saved
     arg('-load-urls'),
     arg('-load-preds'),
+
+    # http response cache shared across runs
+    arg('-cache',         default=osp.join('.cache', 'responses.sqlite')),
+    arg('-no-cache',      action='store_true'),
+    arg('-cache-days',    type=float, default=30),
+
+    # record responses / replay them from replay_server.py
+    arg('-record'),
+    arg('-base-url'),
+
+    # captchas left for captcha_queue.py instead of blocking the run
+    arg('-captcha-queue', default=osp.join('.cache', 'captchas.sqlite')),
+
+    # continue a crashed run in its directory, skipping finished work
+    arg('--resume'),
+
+    # compute a target of dag.py instead, reusing every stored node
+    arg('-dag',           choices=STAGES),
+    arg('-dag-store',     default=osp.join('.cache', 'dag.sqlite')),
+    arg('-refresh',       nargs='*', choices=STAGES, default=()),
+    arg('-labels'),
+
+    # lease words from a work queue shared with other hosts
+    arg('-queue'),
+    # put this run's words on the queue first
+    arg('-enqueue',       action='store_true'),
+    # poll this often while other workers still hold leases
+    arg('-queue-wait',    type=float),
+    arg('-lease-ttl',     type=float, default=600.),
+
+    # also keep urls and preds in a results_store.py db
+    arg('-results'),
+
+    # serve prometheus metrics on this port while running
+    arg('-metrics-port',  type=int),
+
+    # log from a background thread; json lines instead of text
+    arg('-log-queue',     action='store_true'),
+    arg('-log-json',      action='store_true'),
 )
+if opts.dag == 'scores' and not is_(opts.labels):
+    raise SystemExit('-dag scores needs -labels')
+if opts.queue and (opts.dag or opts.pipeline):
+    # leased words only go through the serial loop
+    raise SystemExit('-queue runs words one at a time: drop -%s'
+                     % ('dag' if opts.dag else 'pipeline'))
 
-name = opts.name + '__' if is_(opts.name) else ''
-RESULT_PREFIX = osp.join('reverse-img-final-preds',
-                         '%s_to_%s' % (opts.src, opts.target),
-                         name + time_stamp())
+if opts.resume:
+    RESULT_PREFIX = opts.resume
+else:
+    name = opts.name + '__' if is_(opts.name) else ''
+    RESULT_PREFIX = osp.join('reverse-img-final-preds',
+                             '%s_to_%s' % (opts.src, opts.target),
+                             name + time_stamp())
 mkdir_p(RESULT_PREFIX)
 
-fh = init_logging(file=osp.join(RESULT_PREFIX, 'log.log'),
-                  stdout=True)
+fh = init_logging(file=osp.join(RESULT_PREFIX, 'log.jsonl' if opts.log_json
+                                else 'log.log'),
+                  stdout=True, mode='a' if opts.resume else 'w',
+                  queue=opts.log_queue, json_lines=opts.log_json)
 LOGGER = get_logger(__name__, main=True)
 
 
-from nlp_utils import get_words
-from image_search import image_search
+from nlp_utils import get_words, from_logs
+from image_search import image_search, dedupe_urls
 from reverse_image_search import reverse_search_urls
+from selenium_methods import DRIVER_POOL
+from captcha_queue import CaptchaQueue
+from pipeline import Pipeline, Stage
+from journal import Journal, JournalState, load_journal
+from dag import DAG, NodeStore, run
+from work_queue import WorkQueue, Heartbeat, leases
+from results_store import ResultsStore, URL, PRED
+from metrics import REGISTRY, gauge, histogram, serve_in_thread
+if opts.early_stop:
+    from filter_predictions import EarlyStop
+if opts.pred:
+    from filter_predictions import StreamingPredictor
+from web import SESSIONS, set_cache, set_recorder, set_base_url
+
+cache = None if opts.no_cache else \
+    set_cache(opts.cache, ttl=opts.cache_days * 24 * 3600)
+recorder = set_recorder(opts.record)
+set_base_url(opts.base_url)
+captchas = CaptchaQueue(opts.captcha_queue)
+results, results_run = None, None
+if opts.results:
+    results = ResultsStore(opts.results)
+    results_run = results.run_id(RESULT_PREFIX, opts.src, opts.target)
+
+JOURNAL_PATH = osp.join(RESULT_PREFIX, 'journal.jsonl')
+done = load_journal(JOURNAL_PATH) if opts.resume else JournalState()
+journal = Journal(JOURNAL_PATH)
+if opts.resume:
+    LOGGER.info('RESUME %s: %s' % (RESULT_PREFIX, done))
 
 
 queries = []
@@ -60,32 +176,214 @@ if is_(opts.file):
     queries.extend(get_words(opts.file, i=opts.start, j=opts.stop))
 if is_(opts.query):
     queries.extend(opts.query)
+if done.done:
+    queries = [q for q in queries if q not in done.done]
 
-for i, q in enumerate(queries):
-    LOGGER.info('+++ QUERY #%s: %s +++\n' % (i, q))
+work = None
+if opts.queue:
+    work = WorkQueue(opts.queue, ttl=opts.lease_ttl)
+    if opts.enqueue:
+        LOGGER.info('Queued %s new words' % work.put(queries))
+    queries = []  # the words this worker completes
 
+n_saved = []  # requests saved by early stopping, per word
+
+if opts.metrics_port:
+    metrics_server = serve_in_thread(opts.metrics_port)
+gauge('captcha_queue_pending', 'captchas waiting to be solved') \
+    .set_function(lambda: captchas.stats().get('pending', 0))
+PHASE_SECONDS = histogram('phase_seconds', 'seconds per word in a phase',
+                          ('phase',))
+word_seconds = defaultdict(dict)  # word -> {phase: seconds}
+
+
+def timed(phase):
+    # stages take a word or a (word, ...) tuple
+    def _timed(stage):
+        def _stage(item):
+            start = time.time()
+            try:
+                return stage(item)
+            finally:
+                secs = time.time() - start
+                PHASE_SECONDS.observe(secs, phase=phase)
+                word_seconds[item if isinstance(item, str)
+                             else item[0]][phase] = secs
+        return _stage
+    return _timed
+
+predictor = None
+if opts.pred:
+    predictor = StreamingPredictor(k=opts.pred_k, t=opts.target, query=True,
+                                   fuzzy=opts.fuzzy)
+    prime_dirs = list(opts.pred_prime) + ([RESULT_PREFIX] if opts.resume
+                                          else [])
+    if prime_dirs:
+        predictor.prime(from_logs(*prime_dirs))
+        LOGGER.info('Prediction tf-idf primed with %s words from %s'
+                    % (predictor.tfidf.n_docs, prime_dirs))
+
+
+@timed('search')
+def search_stage(q):
+    # Phase 1 (+ dedup): q -> (q, urls)
     RESULT_DIR = osp.join(RESULT_PREFIX, q)
     mkdir_p(RESULT_DIR)
 
+    if q in done.urls:
+        return q, done.urls[q]
+
+    urls, img_paths = None, None
     if opts.load_urls:
         urls = read_lines(osp.join(opts.load_urls, q, 'urls.txt'))
     elif opts.sch:
-        urls = image_search(q, opts.target)
+        img_dir = osp.join(RESULT_DIR, 'imgs') if opts.save_imgs else None
+        if img_dir:
+            mkdir_p(img_dir)
+        urls, img_paths = image_search(q, opts.target, save=img_dir,
+                                       with_paths=True)
         write_lines(urls, osp.join(RESULT_DIR, 'urls.txt'))
+        if results:
+            results.put(results_run, q, URL, urls)
+
+    if opts.dedup and not opts.load_preds:
+        urls = dedupe_urls(urls, opts.dedup_dist, paths=img_paths,
+                           n_keep=opts.n_img)
+    if urls is not None:
+        journal.urls(q, urls)
+    return q, urls
 
+
+@timed('reverse')
+def reverse_stage(q_urls):
+    # Phase 2: (q, urls) -> (q, preds)
+    q, urls = q_urls
+    RESULT_DIR = osp.join(RESULT_PREFIX, q)
+
+    preds = None
     if opts.load_preds:
         preds = read_lines(osp.join(opts.load_preds, q, 'preds.txt'))
     elif opts.rsch:
+        deferred = []
+        early_stop = EarlyStop(q, z=opts.early_stop,
+                               min_preds=opts.early_min) \
+            if opts.early_stop else None
         preds = reverse_search_urls(q, *urls, lang=opts.target,
-                                    n_img=opts.n_img)
-        write_lines(preds, osp.join(RESULT_DIR, 'preds.txt'))
+                                    n_img=opts.n_img,
+                                    n_workers=opts.n_workers,
+                                    per_proxy=opts.per_proxy,
+                                    deferred=deferred,
+                                    known=done.reverse.get(q),
+                                    on_result=partial(journal.reverse, q),
+                                    early_stop=early_stop)
+        if early_stop:
+            n_saved.append(early_stop.n_saved)
+        preds_path = osp.join(RESULT_DIR, 'preds.txt')
+        write_lines(preds, preds_path)
+        if results:
+            results.put(results_run, q, PRED, preds)
+        for pos, url, d in deferred:
+            captchas.put(preds_path, pos, url, d.query_url, d.proxy,
+                         n_img=opts.n_img, results=opts.results,
+                         run=RESULT_PREFIX, word=q)
+        journal.word_done(q)
+    return q, preds
+
+
+@timed('predict')
+def predict_stage(q_preds):
+    # q, preds -> q, (pred, score, margin)
+    q, preds = q_preds
+    if not preds:
+        return
+    result = predictor.predict(q, preds)
+    if result:
+        LOGGER.info('PREDICTION for %s: %s (score %.3f, margin %.3f)'
+                    % (q, *result))
+        write_lines(['%s\t%.4f\t%.4f' % result],
+                    osp.join(RESULT_PREFIX, q, 'prediction.txt'))
+    return q, result
+
+
+start = time.time()
+if opts.dag:
+    store = NodeStore(opts.dag_store)
+    value = run(DAG(store, opts.refresh), opts.dag,
+                file=opts.file, start=opts.start, stop=opts.stop,
+                query=opts.query, src=opts.src, t=opts.target,
+                n_img=opts.n_img,
+                dedup_dist=opts.dedup_dist if opts.dedup else None,
+                n_workers=opts.n_workers, labels=opts.labels,
+                fuzzy=opts.fuzzy)
+    with open(osp.join(RESULT_PREFIX, opts.dag + '.json'), 'w') as io:
+        json.dump(value, io)
+    LOGGER.info('DAG store: %s' % store.stats())
+    store.close()
+elif opts.pipeline:
+    stages = [Stage('search', search_stage, opts.search_workers),
+              Stage('reverse', reverse_stage, opts.reverse_workers)]
+    if predictor:
+        stages.append(Stage('predict', predict_stage))
+    Pipeline(stages, queue_size=opts.queue_size,
+             report_every=opts.report_every).run(queries)
+elif work:
+    for lease in leases(work, wait=opts.queue_wait):
+        q = lease.key
+        LOGGER.info('+++ LEASED #%s: %s +++\n' % (lease.id, q))
+        with Heartbeat(work, lease) as hb:
+            try:
+                _, preds = reverse_stage(search_stage(q))
+            except Exception:
+                LOGGER.exception('Failed on %s' % q)
+                work.fail(lease, tb.format_exc())
+                continue
+            result = {'preds': preds, 'worker': lease.owner}
+            if predictor:
+                # the preds are saved by now: a failed prediction
+                # mustn't send the word back to the queue
+                try:
+                    result['prediction'] = (predict_stage((q, preds))
+                                            or (q, None))[1]
+                except Exception:
+                    LOGGER.exception('Prediction failed on %s' % q)
+        if hb.lost.is_set() or not work.complete(lease, result):
+            LOGGER.warning('Lost the lease on %s, dropping its result' % q)
+        else:
+            queries.append(q)
+    LOGGER.info('Work queue: %s' % work.stats())
+    work.close()
+else:
+    for i, q in enumerate(queries):
+        LOGGER.info('+++ QUERY #%s: %s +++\n' % (i, q))
+        q_preds = reverse_stage(search_stage(q))
+        if predictor:
+            predict_stage(q_preds)
 
-    # TODO
-    # if opts.pred:
-    #     for top_n in 1, 3, 5, 10, 20, 25:
-    #         for use_lang in True, False:
-    #             pred_filtered = filter_results(preds, q, lang=opts.lang)
-    #             for p in pred_filtered:
-    #                 print(p)
+elapsed = time.time() - start
+LOGGER.info('DONE %s queries in %.1fs (%.2f queries/min)'
+            % (len(queries), elapsed, 60. * len(queries) / max(elapsed, 1e-9)))
+with open(osp.join(RESULT_PREFIX, 'metrics.json'), 'w') as io:
+    json.dump({'elapsed': elapsed, 'n_words': len(queries),
+               'metrics': REGISTRY.summary(), 'words': word_seconds}, io,
+              indent=2)
+if opts.metrics_port:
+    metrics_server.shutdown()
+if opts.early_stop:
+    LOGGER.info('Early stopping saved >= %s requests over %s words'
+                % (sum(n_saved), len(n_saved)))
+LOGGER.info('HTTP sessions: %s' % SESSIONS.stats())
+SESSIONS.close()
+DRIVER_POOL.close()
+LOGGER.info('Captcha queue: %s' % captchas.stats())
+captchas.close()
+if cache:
+    LOGGER.info('HTTP cache: %s' % cache.stats())
+    cache.close()
+if recorder:
+    recorder.close()
+journal.close()
+if results:
+    results.close()
 
+stop_logging()
 fh.close()
\ No newline at end of file
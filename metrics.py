@@ -0,0 +1,205 @@
+"""
+counters, gauges and histograms for a run, served in prometheus' text
+format (main.py -metrics-port) and dumped as json at the end of a run
+"""
+
+import math
+import time
+import threading
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils import get_logger
+
+
+LOGGER = get_logger(__name__)
+
+
+# seconds
+BUCKETS = (.05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., 120., 300.)
+
+
+def label_str(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', r'\\')
+                                          .replace('"', r'\"'))
+                             for k, v in pairs)
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(str(labels.get(k, '')) for k in self.labelnames)
+
+    def samples(self):
+        # [(suffix, label key, extra labels, value)]
+        with self.lock:
+            return [('', key, (), value)
+                    for key, value in sorted(self.values.items())]
+
+    def exposition(self):
+        lines = ['# HELP %s %s' % (self.name, self.doc),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, key, extra, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix,
+                                        label_str(self.labelnames, key,
+                                                  extra),
+                                        repr(float(value))))
+        return '\n'.join(lines)
+
+    def summary(self):
+        return {','.join(key) or '': value
+                for _, key, _, value in self.samples()}
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, n=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, n=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def dec(self, n=1, **labels):
+        self.inc(-n, **labels)
+
+    def set_function(self, f, **labels):
+        # f() is read at every scrape, e.g. a queue's qsize
+        self.set(f, **labels)
+
+    def samples(self):
+        return [(suffix, key, extra, value() if callable(value) else value)
+                for suffix, key, extra, value in super().samples()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=BUCKETS):
+        super().__init__(name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets),
+                                                  0.))
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    counts[i] += 1
+            self.values[key] = counts, total + value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            items = sorted((k, (list(c), s)) for k, (c, s)
+                           in self.values.items())
+        for key, (counts, total) in items:
+            for upper, count in zip(self.buckets, counts):
+                samples.append(('_bucket', key,
+                                (('le', '+Inf' if upper == math.inf
+                                  else repr(upper)),), count))
+            samples.append(('_sum', key, (), total))
+            samples.append(('_count', key, (), counts[-1]))
+        return samples
+
+    def summary(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return {','.join(key) or '': {'count': counts[-1], 'sum': total,
+                                      'mean': total / max(counts[-1], 1)}
+                for key, (counts, total) in items}
+
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def get(self, cls, name, doc, labelnames=(), **kw):
+        # the same metric for the same name, wherever it's declared
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, doc, labelnames, **kw)
+            return self.metrics[name]
+
+    def exposition(self):
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        return '\n'.join(m.exposition() for _, m in metrics) + '\n'
+
+    def summary(self):
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        return {name: m.summary() for name, m in metrics}
+
+
+REGISTRY = Registry()
+
+
+def counter(name, doc, labelnames=()):
+    return REGISTRY.get(Counter, name, doc, labelnames)
+
+
+def gauge(name, doc, labelnames=()):
+    return REGISTRY.get(Gauge, name, doc, labelnames)
+
+
+def histogram(name, doc, labelnames=(), buckets=BUCKETS):
+    return REGISTRY.get(Histogram, name, doc, labelnames, buckets=buckets)
+
+
+### exporter
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.registry.exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        LOGGER.debug(fmt % args)
+
+
+def serve_in_thread(port=9100, host='localhost', registry=REGISTRY):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    LOGGER.info('Metrics on http://%s:%s/metrics' % (host, port))
+    return server
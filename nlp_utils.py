@@ -1,26 +1,77 @@
 import re
 import ast
+import threading
 import unicodedata
 
 import operator as op
 import itertools as it
 
-import enchant
-import langdetect
-
-from stop_words import get_stop_words
-
-from nltk.stem import WordNetLemmatizer
-from nltk.stem.snowball import EnglishStemmer, FrenchStemmer
-from nltk.corpus import stopwords
-
-from french_lefff_lemmatizer.french_lefff_lemmatizer \
-    import FrenchLefffLemmatizer
+from collections.abc import Mapping
 
 from utils import (
     scandir_r,
     get_path_elems_unix,
 )
+from results_store import ResultsStore, PRED
+
+
+### resources
+
+class Resources(object):
+    """
+    enchant dicts, stop word lists, stemmers, lemmatizers...: each is
+    loaded by its loader(lang) on first use, then cached per lang, so
+    importing this module costs nothing until a resource is needed
+    """
+    def __init__(self):
+        self.loaders = {}
+        self.cache = {}
+        self.lock = threading.RLock()
+
+    def register(self, name, loader=None):
+        # also a decorator: @RESOURCES.register(name)
+        if loader is None:
+            return lambda loader: self.register(name, loader)
+        self.loaders[name] = loader
+        return loader
+
+    def get(self, name, lang=None):
+        key = name, lang
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        with self.lock:
+            if key not in self.cache:
+                self.cache[key] = self.loaders[name](lang)
+            return self.cache[key]
+
+    def loaded(self):
+        return sorted(self.cache, key=str)
+
+
+RESOURCES = Resources()
+
+
+class LazyDict(Mapping):
+    # {lang: resource}, loaded per lang on first lookup
+    def __init__(self, name, langs):
+        self.name = name
+        self.langs = tuple(langs)
+
+    def __getitem__(self, lang):
+        if lang not in self.langs:
+            raise KeyError(lang)
+        return RESOURCES.get(self.name, lang)
+
+    def __iter__(self):
+        return iter(self.langs)
+
+    def __len__(self):
+        return len(self.langs)
+
+
+LANG_NAMES = {'en': 'english', 'fr': 'french'}
 
 
 ### basic
@@ -58,6 +109,19 @@ def from_logs(*folders, root=None, filename='preds.txt'):
             yield word, preds
 
 
+def from_store(path, run, kind=PRED):
+    """
+    (word, preds) of a run in a results_store db, in sort_by_word's
+    order; run is its name (e.g. fr_to_en/all_words) or id
+    """
+    store = ResultsStore(path)
+    try:
+        run_id = run if isinstance(run, int) else store.find_run(run)
+        return store.word_values(run_id, kind)
+    finally:
+        store.close()
+
+
 def sort_by_word(path):
     """
     return list of words and their lists of reverse image
@@ -85,11 +149,32 @@ def lang_params(lang, as_list=False, throw=False):
 
 ### stop words
 
-stop_words_nltk_fr = set(stopwords.words('french'))
-stop_words_nltk_en = set(stopwords.words('english'))
+@RESOURCES.register('stop_words_nltk')
+def load_stop_words_nltk(lang):
+    from nltk.corpus import stopwords
+    return set(stopwords.words(LANG_NAMES[lang]))
+
+
+@RESOURCES.register('stop_words_alt')
+def load_stop_words_alt(lang):
+    from stop_words import get_stop_words
+    return set(get_stop_words(lang))
+
+
+def stop_words(kind, lang):
+    # kind: 'nltk' or 'alt'
+    return RESOURCES.get('stop_words_' + kind, lang)
+
 
-stop_words_alt_fr = set(get_stop_words('fr'))
-stop_words_alt_en = set(get_stop_words('en'))
+# stop_words_nltk_fr, stop_words_alt_en, ... as before, loaded on access
+STOP_WORDS_ATTR = re.compile(r'^stop_words_(nltk|alt)_([a-z]{2})$')
+
+
+def __getattr__(name):
+    m = STOP_WORDS_ATTR.match(name)
+    if m:
+        return stop_words(*m.groups())
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
 
 
 ### POS
@@ -129,8 +214,13 @@ def get_pos_code(labels, pos_code_dict=POS_CODE_DCT):
 
 ### stemming
 
-STEMMERS = {'en': EnglishStemmer().stem,
-            'fr': FrenchStemmer().stem}
+@RESOURCES.register('stemmer')
+def load_stemmer(lang):
+    from nltk.stem.snowball import EnglishStemmer, FrenchStemmer
+    return {'en': EnglishStemmer, 'fr': FrenchStemmer}[lang]().stem
+
+
+STEMMERS = LazyDict('stemmer', ('en', 'fr'))
 
 def stem_compare(w1, w2, lang='en'):
     stemmer = STEMMERS[lang]
@@ -139,8 +229,17 @@ def stem_compare(w1, w2, lang='en'):
 
 ### lemmatizing
 
-LEMMATIZERS = {'en': WordNetLemmatizer,
-               'fr': FrenchLefffLemmatizer}
+@RESOURCES.register('lemmatizer')
+def load_lemmatizer_class(lang):
+    if lang == 'en':
+        from nltk.stem import WordNetLemmatizer
+        return WordNetLemmatizer
+    from french_lefff_lemmatizer.french_lefff_lemmatizer \
+        import FrenchLefffLemmatizer
+    return FrenchLefffLemmatizer
+
+
+LEMMATIZERS = LazyDict('lemmatizer', ('en', 'fr'))
 
 
 def get_lem(lemmer_class, get_pos_code, **kwargs):
@@ -160,11 +259,24 @@ def get_lem(lemmer_class, get_pos_code, **kwargs):
 
 ### word dict lookup
 
+@RESOURCES.register('enchant')
+def load_enchant(code):
+    import enchant
+    return enchant.Dict(code)
+
+
+@RESOURCES.register('langdetect')
+def load_langdetect(_):
+    import langdetect
+    return langdetect
+
+
 def is_lang(lang):
     code = 'fr_FR' if lang.lower().startswith('fr') \
       else 'en_US' if lang.lower().startswith('en') \
       else (lang or 'en_US')
-    dictionary = enchant.Dict(code)
+    dictionary = RESOURCES.get('enchant', code)
+    langdetect = RESOURCES.get('langdetect')
     def _is_lang(word):
         ld_check  = lang in {lr.lang for lr in langdetect.detect_langs(word)}
         dct_check = dictionary.check(word)
@@ -0,0 +1,124 @@
+"""
+producer/consumer runner: stages with their own worker threads,
+connected by bounded queues
+"""
+
+import time
+import queue
+import threading
+
+import traceback as tb
+
+from utils import get_logger
+from metrics import gauge
+
+
+LOGGER = get_logger(__name__)
+
+
+QUEUE_DEPTH = gauge('pipeline_queue_depth', 'items waiting for a stage',
+                    ('stage',))
+
+
+# sentinel telling a worker its input is exhausted
+STOP = object()
+
+
+class Stage(object):
+    """
+    fn(item) -> item for the next stage; returning None drops the item
+    """
+    def __init__(self, name, fn, n_workers=1):
+        self.name = name
+        self.fn = fn
+        self.n_workers = n_workers
+        self.lock = threading.Lock()
+        self.n_done = self.n_dropped = self.n_errors = 0
+        self.busy = 0.
+        self.n_running = 0
+
+    def process(self, item):
+        start = time.time()
+        try:
+            out = self.fn(item)
+        except:
+            LOGGER.error('Stage %s failed on %s\n%s'
+                         % (self.name, item, tb.format_exc()))
+            out, err = None, True
+        else:
+            err = False
+        with self.lock:
+            self.busy += time.time() - start
+            self.n_done += 1
+            self.n_errors += err
+            self.n_dropped += out is None and not err
+        return out
+
+    def report(self, elapsed, q=None):
+        with self.lock:
+            return ('%s: %s done (%.2f/min), %s errors, %s dropped,'
+                    ' %.0f%% busy, queue %s'
+                    % (self.name, self.n_done,
+                       60. * self.n_done / max(elapsed, 1e-9),
+                       self.n_errors, self.n_dropped,
+                       100. * self.busy / max(elapsed * self.n_workers, 1e-9),
+                       q.qsize() if q else '-'))
+
+
+class Pipeline(object):
+    def __init__(self, stages, queue_size=4, report_every=60.):
+        self.stages = stages
+        self.queues = [queue.Queue(queue_size) for _ in stages]
+        self.report_every = report_every
+        self.done = threading.Event()
+        self.start = None
+
+    def worker(self, k):
+        stage, q_in = self.stages[k], self.queues[k]
+        q_out = self.queues[k+1] if k + 1 < len(self.stages) else None
+        while True:
+            item = q_in.get()
+            if item is STOP:
+                break
+            out = stage.process(item)
+            if q_out is not None and out is not None:
+                q_out.put(out)  # blocks while the next stage is behind
+        with stage.lock:
+            stage.n_running -= 1
+            last = stage.n_running == 0
+        if last and q_out is not None:
+            for _ in range(self.stages[k+1].n_workers):
+                q_out.put(STOP)
+
+    def reporter(self):
+        while not self.done.wait(self.report_every):
+            self.log_report()
+
+    def log_report(self):
+        elapsed = time.time() - self.start
+        LOGGER.info('PIPELINE after %.0fs\n\t%s' % (elapsed, '\n\t'.join(
+            stage.report(elapsed, q)
+            for stage, q in zip(self.stages, self.queues))))
+
+    def run(self, items):
+        self.start = time.time()
+        for stage, q in zip(self.stages, self.queues):
+            QUEUE_DEPTH.set_function(q.qsize, stage=stage.name)
+        threads = []
+        for k, stage in enumerate(self.stages):
+            stage.n_running = stage.n_workers
+            for j in range(stage.n_workers):
+                threads.append(threading.Thread(
+                    target=self.worker, args=(k,), daemon=True,
+                    name='%s-%s' % (stage.name, j)))
+        threads.append(threading.Thread(target=self.reporter, daemon=True))
+        for t in threads:
+            t.start()
+        for item in items:
+            self.queues[0].put(item)
+        for _ in range(self.stages[0].n_workers):
+            self.queues[0].put(STOP)
+        for t in threads[:-1]:
+            t.join()
+        self.done.set()
+        self.log_report()
@@ -0,0 +1,261 @@
+"""
+proxy health tracking, routing and circuit breakers
+"""
+
+import time
+import threading
+
+from statistics import median
+
+from utils import get_logger
+
+
+LOGGER = get_logger(__name__)
+
+
+### config
+
+# weight of the newest sample in the moving averages
+ALPHA = .2
+
+# assumed latency (s) of an unused proxy while no proxy has been used;
+# after that, unused ones are assumed as fast as the median used one
+LATENCY_PRIOR = 2.
+
+# consecutive 503/captcha/connection failures that open a breaker
+N_FAILS = 3
+
+# seconds an open breaker waits before letting a probe through;
+# doubled each time a probe fails, up to MAX_COOLDOWN
+COOLDOWN = 120.
+MAX_COOLDOWN = 1800.
+
+
+### outcomes
+
+OK, BAD, CAPTCHA, ERROR = 'ok', 'bad', 'captcha', 'error'
+
+CAPTCHA_CODES = frozenset({429, 503})
+
+
+def outcome(status_code):
+    if status_code in CAPTCHA_CODES:
+        return CAPTCHA
+    # e.g. 404 for a dead image: the proxy itself worked
+    return OK if status_code < 400 else BAD
+
+
+### circuit breaker
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+
+class CircuitBreaker(object):
+    def __init__(self, n_fails=N_FAILS, cooldown=COOLDOWN,
+                 max_cooldown=MAX_COOLDOWN):
+        self.n_fails = n_fails
+        self.base_cooldown = self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.state = CLOSED
+        self.fails = 0
+        self.opened_at = None
+        self.probing = False
+        self.n_trips = 0
+
+    def poll(self, now):
+        if self.state == OPEN and now - self.opened_at >= self.cooldown:
+            self.state = HALF_OPEN
+            self.probing = False
+        return self.state
+
+    def available(self, now):
+        state = self.poll(now)
+        return state == CLOSED or state == HALF_OPEN and not self.probing
+
+    def time_left(self, now):
+        if self.poll(now) != OPEN:
+            return 0.
+        return self.opened_at + self.cooldown - now
+
+    def lease(self):
+        # only one request probes a half-open proxy
+        if self.state == HALF_OPEN:
+            self.probing = True
+
+    def success(self):
+        if self.state == HALF_OPEN:
+            self.state = CLOSED
+            self.cooldown = self.base_cooldown
+        self.fails = 0
+        self.probing = False
+
+    def failure(self, now):
+        if self.state == HALF_OPEN:
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            return self.trip(now)
+        self.fails += 1
+        if self.state == CLOSED and self.fails >= self.n_fails:
+            self.trip(now)
+
+    def trip(self, now):
+        self.state = OPEN
+        self.opened_at = now
+        self.fails = 0
+        self.probing = False
+        self.n_trips += 1
+
+
+### health
+
+def ewma(avg, x, alpha=ALPHA):
+    return x if avg is None else alpha * x + (1 - alpha) * avg
+
+
+class ProxyHealth(object):
+    def __init__(self, proxy, **breaker_kw):
+        self.proxy = proxy
+        self.breaker = CircuitBreaker(**breaker_kw)
+        self.latency = None
+        self.success = 1.
+        self.captcha = 0.
+        self.inflight = 0
+        self.last_used = 0.
+        self.counts = {OK: 0, BAD: 0, CAPTCHA: 0, ERROR: 0}
+
+    def score(self, prior=LATENCY_PRIOR):
+        # higher is healthier; busy proxies are discounted so load spreads.
+        # captchas already count against success, so only once
+        latency = prior if self.latency is None else self.latency
+        return self.success / (max(latency, 1e-3) * (1 + self.inflight))
+
+    def record(self, latency, result, now):
+        if result != ERROR:
+            self.latency = ewma(self.latency, latency)
+        self.success = ewma(self.success, result in (OK, BAD))
+        self.captcha = ewma(self.captcha, result == CAPTCHA)
+        self.counts[result] += 1
+        if result in (OK, BAD):
+            self.breaker.success()
+        else:
+            self.breaker.failure(now)
+
+    def summary(self, prior=LATENCY_PRIOR):
+        return {'state': self.breaker.state,
+                'score': round(self.score(prior), 4),
+                'latency': self.latency and round(self.latency, 3),
+                'success_rate': round(self.success, 3),
+                'captcha_rate': round(self.captcha, 3),
+                'inflight': self.inflight,
+                'trips': self.breaker.n_trips,
+                **self.counts}
+
+
+### manager
+
+class ProxyManager(object):
+    """
+    routes each request to the healthiest available proxy; `proxies` is
+    shared with the caller, so proxies added to it later are picked up
+    """
+    def __init__(self, proxies, max_inflight=None, **breaker_kw):
+        self.proxies = proxies
+        self.max_inflight = max_inflight
+        self.breaker_kw = breaker_kw
+        self.health = {}
+        self.cond = threading.Condition()
+        self.local = threading.local()
+
+    def get(self, proxy):
+        # callers hold the lock
+        if proxy not in self.health:
+            self.health[proxy] = ProxyHealth(proxy, **self.breaker_kw)
+        return self.health[proxy]
+
+    def candidates(self, now, max_inflight=None):
+        # max_inflight: this caller's limit, else the manager's
+        if max_inflight is None:
+            max_inflight = self.max_inflight
+        for proxy in self.proxies:
+            h = self.get(proxy)
+            if h.breaker.available(now) and (
+                    max_inflight is None or h.inflight < max_inflight):
+                yield h
+
+    def latency_prior(self):
+        # callers hold the lock; unused proxies rank with the median one
+        # instead of behind every fast one, so each gets tried early
+        seen = [h.latency for h in self.health.values()
+                if h.latency is not None]
+        return median(seen) if seen else LATENCY_PRIOR
+
+    def best(self, now, max_inflight=None):
+        prior = self.latency_prior()
+        return max(self.candidates(now, max_inflight), default=None,
+                   key=lambda h: (h.score(prior), -h.last_used))
+
+    def peek(self, max_inflight=None):
+        with self.cond:
+            h = self.best(time.time(), max_inflight)
+            return h and h.proxy
+
+    def choose(self, max_inflight=None):
+        with self.cond:
+            warned = False
+            while True:
+                now = time.time()
+                h = self.best(now, max_inflight)
+                if h is not None:
+                    break
+                # proxies are either cooling down or busy; busy ones
+                # wake us when their request finishes
+                wait = min(filter(None, (self.get(p).breaker.time_left(now)
+                                         for p in self.proxies)),
+                           default=None)
+                if wait and not warned:
+                    LOGGER.warning('No proxy available, next probe in %.1fs'
+                                   % wait)
+                    warned = True
+                self.cond.wait(wait)
+            h.breaker.lease()
+            return self.lease(h, now)
+
+    def begin(self, proxy):
+        with self.cond:
+            return self.lease(self.get(proxy), time.time())
+
+    def lease(self, h, now):
+        h.inflight += 1
+        h.last_used = now
+        self.local.last = h.proxy
+        return h.proxy
+
+    def end(self, proxy, latency, result):
+        with self.cond:
+            h = self.get(proxy)
+            h.inflight = max(0, h.inflight - 1)
+            state = h.breaker.state
+            h.record(latency, result, time.time())
+            if h.breaker.state != state:
+                log = LOGGER.warning if h.breaker.state == OPEN \
+                    else LOGGER.info
+                log('PROXY %s breaker %s -> %s (%s)',
+                    proxy, state, h.breaker.state,
+                    h.summary(self.latency_prior()))
+            self.cond.notify_all()
+
+    def last(self):
+        # the proxy most recently handed out to this thread
+        return getattr(self.local, 'last', None)
+
+    def n_available(self):
+        with self.cond:
+            now = time.time()
+            return sum(self.get(p).breaker.poll(now) != OPEN
+                       for p in self.proxies)
+
+    def summary(self, proxy=None):
+        with self.cond:
+            prior = self.latency_prior()
+            if proxy is not None:
+                return self.get(proxy).summary(prior)
+            return {p: self.get(p).summary(prior) for p in self.proxies}
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3.7
 from utils import arg, parse_args
+from web import set_recorder, set_base_url
 from image_search import image_search
 from reverse_image_search import reverse_search_urls
 
@@ -8,9 +9,16 @@ opts = parse_args(
     arg('-t', '--target', default='en'),
     arg('-n', '--n-img',  type=int, default=3),
     arg('-d', '--debug', action='store_true'),
+    arg('-record'),
+    arg('-base-url'),
 )
 
+recorder = set_recorder(opts.record)
+set_base_url(opts.base_url)
+
 urls  = image_search(opts.query, opts.target, debug=opts.debug)
-preds = reverse_search_urls(opts.query, *urls, opts.target,
-                            opts.n_img, opts.debug)
-print(preds)
\ No newline at end of file
+preds = reverse_search_urls(opts.query, *urls, lang=opts.target,
+                            n_img=opts.n_img, debug=opts.debug)
+print(preds)
+if recorder:
+    recorder.close()
\ No newline at end of file
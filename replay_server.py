@@ -0,0 +1,87 @@
+"""
+local stand-in for google image search, searchbyimage and image hosts:
+replays responses recorded with `web.set_recorder` (main.py -record).
+point the pipeline at it with main.py / quickpred.py -base-url
+"""
+
+import time
+import random
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils import arg, parse_args, get_logger, init_logging
+from response_cache import ResponseCache
+
+
+LOGGER = get_logger(__name__)
+
+
+def original_url(path):
+    # inverse of web.rewrite_url: /https/host/path?q -> https://host/path?q
+    scheme, _, rest = path.lstrip('/').partition('/')
+    return '%s://%s' % (scheme, rest)
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        resp = server.store.get(original_url(self.path))
+        with server.lock:
+            server.counts['hits' if resp else 'misses'] += 1
+        lo, hi = server.latency
+        if hi:
+            time.sleep(random.uniform(lo, hi) if hi > lo else hi)
+        if resp is None:
+            body, status, ctype = b'not recorded', 404, 'text/plain'
+        else:
+            body, status = resp.content, resp.status_code
+            ctype = resp.headers.get('Content-Type', 'text/html')
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        LOGGER.debug(fmt % args)
+
+
+def make_server(recording, host='localhost', port=8000, latency=(0., 0.)):
+    server = ThreadingHTTPServer((host, port), ReplayHandler)
+    server.daemon_threads = True
+    server.store = ResponseCache(recording, ttl=None, max_bytes=None)
+    server.latency = latency
+    server.lock = threading.Lock()
+    server.counts = {'hits': 0, 'misses': 0}
+    return server
+
+
+def serve_in_thread(*args, **kw):
+    server = make_server(*args, **kw)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    opts = parse_args(
+        arg('-r', '--recording', required=True),
+        arg('-host',             default='localhost'),
+        arg('-p', '--port',      type=int, default=8000),
+        # seconds per response: fixed, or a uniform interval
+        arg('-l', '--latency',   type=float, nargs='+', default=[0.]),
+    )
+    init_logging(stdout=True)
+    latency = opts.latency * 2 if len(opts.latency) == 1 else opts.latency
+    server = make_server(opts.recording, opts.host, opts.port, latency[:2])
+    LOGGER.info('Replaying %s on http://%s:%s'
+                % (opts.recording, opts.host, opts.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        LOGGER.info('Replay: %s' % server.counts)
+        server.server_close()
@@ -0,0 +1,174 @@
+"""
+persistent, content-addressed http response cache
+"""
+
+import time
+import zlib
+import hashlib
+
+from urllib import parse as urlparse
+
+import ujson as json
+
+from utils import is_, get_logger, SqliteStore
+
+
+LOGGER = get_logger(__name__)
+
+
+# seconds a cached response stays fresh (None: forever)
+TTL = 30 * 24 * 3600.
+
+# total compressed bytes kept before least recently used entries go
+MAX_BYTES = 2 * 1024 ** 3
+
+ZLIB_LEVEL = 6
+
+
+### keys
+
+def canonical_url(url):
+    # same request -> same string, whatever the param order or quoting;
+    # REVERSE_QUERY_URL shuffles its params
+    parts = urlparse.urlsplit(url.strip())
+    params = sorted(urlparse.parse_qsl(parts.query, keep_blank_values=True))
+    return urlparse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(),
+                                parts.path or '/',
+                                urlparse.urlencode(params), ''))
+
+
+def cache_key(url):
+    return hashlib.sha1(canonical_url(url).encode()).hexdigest()
+
+
+### responses
+
+class CachedResponse(object):
+    from_cache = True
+
+    def __init__(self, url, status_code, content, headers=None):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    @property
+    def encoding(self):
+        ctype = self.headers.get('Content-Type', '')
+        for param in ctype.split(';')[1:]:
+            k, _, v = param.strip().partition('=')
+            if k.lower() == 'charset' and v:
+                return v.strip('"\'')
+        return 'utf-8'
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors='replace')
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i+chunk_size]
+
+    def close(self):
+        pass
+
+
+# headers worth replaying
+KEEP_HEADERS = 'Content-Type', 'Content-Length'
+
+
+### cache
+
+class ResponseCache(SqliteStore):
+    def __init__(self, path, ttl=TTL, max_bytes=MAX_BYTES,
+                 level=ZLIB_LEVEL):
+        super().__init__(path)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.level = level
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                        ' key TEXT PRIMARY KEY, url TEXT, status INTEGER,'
+                        ' headers TEXT, body BLOB, size INTEGER,'
+                        ' created REAL, accessed REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS by_access'
+                        ' ON responses (accessed)')
+        self.db.commit()
+        self.total = self.db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        self.counts = {'hits': 0, 'misses': 0, 'expired': 0,
+                       'stores': 0, 'evictions': 0}
+
+    def get(self, url):
+        key, now = cache_key(url), time.time()
+        with self.lock:
+            row = self.db.execute(
+                'SELECT status, headers, body, created FROM responses'
+                ' WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.counts['misses'] += 1
+                return
+            status, headers, body, created = row
+            if is_(self.ttl) and now - created > self.ttl:
+                self.counts['expired'] += 1
+                self.counts['misses'] += 1
+                self.delete(key)
+                return
+            self.db.execute('UPDATE responses SET accessed = ? WHERE key = ?',
+                            (now, key))
+            self.db.commit()
+            self.counts['hits'] += 1
+        return CachedResponse(url, status, zlib.decompress(body),
+                              json.loads(headers))
+
+    def put(self, url, resp):
+        headers = {h: resp.headers[h] for h in KEEP_HEADERS
+                   if h in resp.headers}
+        body = zlib.compress(resp.content, self.level)
+        key, now = cache_key(url), time.time()
+        with self.lock:
+            self.delete(key)
+            self.db.execute('INSERT INTO responses VALUES (?,?,?,?,?,?,?,?)',
+                            (key, url, resp.status_code, json.dumps(headers),
+                             body, len(body), now, now))
+            self.total += len(body)
+            self.counts['stores'] += 1
+            self.evict()
+            self.db.commit()
+
+    def delete(self, key):
+        # callers hold the lock
+        row = self.db.execute('SELECT size FROM responses WHERE key = ?',
+                              (key,)).fetchone()
+        if row:
+            self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.total -= row[0]
+
+    def evict(self):
+        # callers hold the lock
+        if not is_(self.max_bytes):
+            return
+        while self.total > self.max_bytes:
+            rows = self.db.execute('SELECT key, size FROM responses'
+                                   ' ORDER BY accessed LIMIT 64').fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.total <= self.max_bytes:
+                    break
+                self.db.execute('DELETE FROM responses WHERE key = ?',
+                                (key,))
+                self.total -= size
+                self.counts['evictions'] += 1
+
+    def __contains__(self, url):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM responses WHERE key = ?',
+                                   (cache_key(url),)).fetchone() is not None
+
+    def stats(self):
+        with self.lock:
+            n = self.db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            lookups = self.counts['hits'] + self.counts['misses']
+            return {**self.counts, 'entries': n, 'bytes': self.total,
+                    'hit_rate': self.counts['hits'] / lookups
+                                if lookups else 0.}
@@ -0,0 +1,164 @@
+"""
+one sqlite file for all runs' urls and preds, instead of a
+<run>/<word>/{urls,preds}.txt tree per run. rows are keyed by run,
+word, kind and rank, runs by language pair, so loading a run is one
+query:
+
+    python results_store.py -db results.sqlite -import reverse-img-preds
+    python results_store.py -db results.sqlite -runs
+"""
+
+import os
+import re
+import time
+
+from collections import defaultdict
+
+from utils import (
+    arg,
+    read_lines,
+    scandir_r,
+    parse_args,
+    get_logger,
+    init_logging,
+    SqliteStore,
+)
+
+
+LOGGER = get_logger(__name__)
+
+
+URL, PRED = 'url', 'pred'
+FILES = {'urls.txt': URL, 'preds.txt': PRED}
+
+LANG_PAIR = re.compile(r'^([a-z]+)_to_([a-z]+)$')
+
+
+class ResultsStore(SqliteStore):
+    def __init__(self, path):
+        super().__init__(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS runs ('
+                        ' id INTEGER PRIMARY KEY, name TEXT UNIQUE,'
+                        ' src TEXT, target TEXT, created REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS runs_lang'
+                        ' ON runs (src, target)')
+        # word_key: sort_by_word's order, lowercased. every word has a
+        # rank 0 row with a null value, so words without values are kept
+        self.db.execute('CREATE TABLE IF NOT EXISTS results ('
+                        ' run INTEGER, word_key TEXT, word TEXT,'
+                        ' kind TEXT, rank INTEGER, value TEXT,'
+                        ' PRIMARY KEY (run, word_key, word, kind, rank))'
+                        ' WITHOUT ROWID')
+        self.db.commit()
+
+    def run_id(self, name, src=None, target=None):
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO runs (name, src, target,'
+                            ' created) VALUES (?,?,?,?)',
+                            (name, src, target, time.time()))
+            self.db.commit()
+            return self.db.execute('SELECT id FROM runs WHERE name = ?',
+                                   (name,)).fetchone()[0]
+
+    def put(self, run, word, kind, values):
+        # replaces the word's values of this kind, ranked from 1; values
+        # may be empty
+        self.put_many(run, [(word, kind, values)])
+
+    def put_many(self, run, entries):
+        # entries: [(word, kind, values)], in one transaction
+        with self.lock:
+            for word, kind, values in entries:
+                self.db.execute('DELETE FROM results WHERE run = ?'
+                                ' AND word_key = ? AND word = ?'
+                                ' AND kind = ?',
+                                (run, word.lower(), word, kind))
+                self.db.executemany(
+                    'INSERT INTO results VALUES (?,?,?,?,?,?)',
+                    [(run, word.lower(), word, kind, 0, None)]
+                    + [(run, word.lower(), word, kind, i + 1, v)
+                       for i, v in enumerate(values)])
+            self.db.commit()
+
+    def word_values(self, run, kind=PRED):
+        # [(word, values)] sorted as nlp_utils.sort_by_word does
+        with self.lock:
+            rows = self.db.execute('SELECT word, value FROM results'
+                                   ' WHERE run = ? AND kind = ?'
+                                   ' ORDER BY word_key, word, rank',
+                                   (run, kind)).fetchall()
+        word_values = []
+        for word, value in rows:
+            if not word_values or word_values[-1][0] != word:
+                word_values.append((word, []))
+            if value is not None:
+                word_values[-1][1].append(value)
+        return word_values
+
+    def runs(self, src=None, target=None):
+        # [(id, name, src, target)], optionally for one language pair
+        where, args = [], []
+        for col, val in (('src', src), ('target', target)):
+            if val:
+                where.append(col + ' = ?')
+                args.append(val)
+        with self.lock:
+            return self.db.execute(
+                'SELECT id, name, src, target FROM runs'
+                + (' WHERE ' + ' AND '.join(where) if where else '')
+                + ' ORDER BY id', args).fetchall()
+
+    def find_run(self, name):
+        with self.lock:
+            row = self.db.execute('SELECT id FROM runs WHERE name = ?',
+                                  (name,)).fetchone()
+        if row:
+            return row[0]
+
+
+### import
+
+def lang_pair(path):
+    # (src, target) from a <src>_to_<target> dir in path
+    for elem in reversed(path.split(os.sep)):
+        m = LANG_PAIR.match(elem)
+        if m:
+            return m.groups()
+    return None, None
+
+
+def import_tree(store, root):
+    """
+    every <run>/<word>/{urls,preds}.txt under root; runs are named by
+    their path from root, e.g. fr_to_en/all_words
+    """
+    runs = defaultdict(list)
+    for f in scandir_r(root):
+        if f.name in FILES:
+            word_dir = os.path.dirname(f.path)
+            run_dir = os.path.dirname(word_dir)
+            runs[run_dir].append((os.path.basename(word_dir),
+                                  FILES[f.name], read_lines(f.path)))
+    for run_dir, entries in sorted(runs.items()):
+        name = os.path.relpath(run_dir, root)
+        run = store.run_id(name, *lang_pair(os.path.abspath(run_dir)))
+        store.put_many(run, entries)
+        LOGGER.info('Imported %s: %s words' % (
+            name, len({word for word, _, _ in entries})))
+    return len(runs)
+
+
+if __name__ == '__main__':
+    opts = parse_args(
+        arg('-db', default='results.sqlite'),
+        arg('-import', dest='roots', nargs='*', default=()),
+        arg('-runs', action='store_true'),
+    )
+    init_logging(stdout=True)
+    store = ResultsStore(opts.db)
+    for root in opts.roots:
+        import_tree(store, root)
+    if opts.runs:
+        for run in store.runs():
+            print('%s\t%s\t%s_to_%s' % run)
+    store.close()
@@ -0,0 +1,133 @@
+"""
+retry policies: error classification, backoff with jitter, retry budgets
+"""
+
+import time
+import random
+import threading
+
+import requests
+
+from proxy_manager import CAPTCHA_CODES
+from metrics import counter
+
+
+### classification
+
+RETRYABLE, FATAL, CAPTCHA = 'retryable', 'fatal', 'captcha'
+
+RETRYABLE_CODES = frozenset({408, 500, 502, 504})
+
+
+def classify(ex):
+    code = getattr(ex, 'code', None)  # web.BadStatusCode
+    if code in CAPTCHA_CODES:
+        return CAPTCHA
+    if code in RETRYABLE_CODES:
+        return RETRYABLE
+    if isinstance(ex, (requests.exceptions.ConnectionError,
+                       requests.exceptions.Timeout,
+                       requests.exceptions.ChunkedEncodingError)):
+        return RETRYABLE
+    # other status codes, parse failures, bugs: retrying won't help
+    return FATAL
+
+
+### backoff
+
+class DecorrelatedJitter(object):
+    # sleep_i = min(cap, uniform(base, 3 * sleep_{i-1}))
+    def __init__(self, base=1., cap=30.):
+        self.base = base
+        self.cap = cap
+
+    def delays(self):
+        delay = self.base
+        while True:
+            delay = min(self.cap, random.uniform(self.base, delay * 3))
+            yield delay
+
+
+### budget
+
+class RetryBudget(object):
+    """
+    caps retries at `ratio` of all attempts (plus `min_retries` so a
+    run can retry early on); shared by every policy using it
+    """
+    def __init__(self, ratio=.2, min_retries=10):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.lock = threading.Lock()
+        self.n_attempts = self.n_retries = self.n_denied = 0
+
+    def attempt(self):
+        with self.lock:
+            self.n_attempts += 1
+
+    def spend(self):
+        with self.lock:
+            if self.n_retries < self.min_retries + \
+                    self.ratio * self.n_attempts:
+                self.n_retries += 1
+                return True
+            self.n_denied += 1
+            return False
+
+    def stats(self):
+        with self.lock:
+            return {'attempts': self.n_attempts, 'retries': self.n_retries,
+                    'denied': self.n_denied}
+
+
+BUDGET = RetryBudget()
+
+
+### metrics
+
+ERRORS = counter('request_errors_total', 'failed tries by error class',
+                 ('kind',))
+RETRIES = counter('request_retries_total', 'retries by error class',
+                  ('kind',))
+BUDGET_EXHAUSTED = counter('retry_budget_exhausted_total',
+                           'retries refused by the retry budget')
+
+
+### policy
+
+class RetryPolicy(object):
+    def __init__(self, n_tries=2, backoff=None, budget=BUDGET,
+                 timeout=(10., 30.), retry_on=(RETRYABLE,),
+                 classify=classify):
+        self.n_tries = n_tries
+        self.backoff = backoff or DecorrelatedJitter()
+        self.budget = budget
+        self.timeout = timeout
+        self.retry_on = retry_on
+        self.classify = classify
+
+    def run(self, attempt, on_retry=None):
+        """
+        attempt(i, timeout) -> result, for i in 0..n_tries-1;
+        on_retry(ex, kind, i, delay) is called from inside the except
+        block before sleeping
+        """
+        delays = self.backoff.delays()
+        for i in range(self.n_tries):
+            if self.budget:
+                self.budget.attempt()
+            try:
+                return attempt(i, self.timeout)
+            except Exception as ex:
+                kind = self.classify(ex)
+                ERRORS.inc(kind=kind)
+                if i >= self.n_tries - 1 or kind not in self.retry_on:
+                    raise
+                if self.budget and not self.budget.spend():
+                    BUDGET_EXHAUSTED.inc()
+                    raise
+                RETRIES.inc(kind=kind)
+                delay = next(delays)
+                if on_retry:
+                    on_retry(ex, kind, i, delay)
+                time.sleep(delay)
@@ -1,44 +1,81 @@
-from collections import defaultdict
+import copy
+import asyncio
+
+from functools import partial
 from urllib import parse as urlparse
+from concurrent.futures import ThreadPoolExecutor
 
 from bs4 import BeautifulSoup
 
 from nlp_utils import lang_params
-from utils import get_logger, sample
+from html_extract import extract_card_text
+from utils import is_, get_logger, sample
 from selenium_methods import reverse_search_selenium
+from metrics import counter
 from web import (
-    retry,
+    request,
     prev_proxy,
     log_web_err,
     BadStatusCode,
     PROXIES,
+    PROXY_MANAGER,
+)
+from proxy_manager import CAPTCHA_CODES
+from retry_policy import (
+    RetryPolicy,
+    DecorrelatedJitter,
+    RETRYABLE,
+    CAPTCHA,
 )
 
 
 LOGGER = get_logger(__name__)
 
 
-def parse_reverse_prediction(resp, from_request=True):
+def parse_reverse_prediction(resp, from_request=True, fast=True):
     if from_request:
         resp = resp.text
+    if fast:
+        pred = extract_card_text(resp)
+        if pred is not None:
+            return pred
     soup = BeautifulSoup(resp, 'lxml')
     card = soup.find('div', {'class': 'card-section'})
     # error if card is None or no such tag
     return card.next.nextSibling.a.text
 
 
+def has_prediction(resp):
+    # only these pages are cached, not captchas or pages without a card
+    try:
+        return bool(parse_reverse_prediction(resp))
+    except Exception:
+        return False
+
+
 class TriggeredCaptcha(Exception):
     pass
 
 
-# 503/captcha fail tolerance
-N_FAILS = 3
+# what to do with a captcha the headless browser can't get past:
+# 'defer' it to the captcha queue (see captcha_queue.py) and move on,
+# or 'block' until it is solved by hand
+CAPTCHA_MODE = 'defer'
 
-# if using proxies
-CAPTCHA_COUNT = defaultdict(int)
-N_PROXY_THRESH = 1
 
-# if no proxies
+class Deferred(object):
+    # returned instead of a pred for a search left to the captcha queue
+    def __init__(self, query_url, proxy=None):
+        self.query_url = query_url
+        self.proxy = proxy
+
+    def __bool__(self):
+        return False
+
+
+# 503/captcha fail tolerance if no proxies; proxies are never dropped,
+# PROXY_MANAGER cools them down instead
+N_FAILS = 3
 _503_COUNT = 0
 
 
@@ -52,29 +89,31 @@ def check_ip():
         LOGGER.error('Hit 503 Codes for %s image(s)' % _503_COUNT)
 
 
-def check_proxies():
+def check_proxies(proxy=None):
     if not PROXIES:
         return check_ip()
-    proxy = prev_proxy()
-    CAPTCHA_COUNT[proxy] += 1
-    if CAPTCHA_COUNT[proxy] >= N_FAILS:
-        LOGGER.error('PROXY %s hit 503 Codes for %s images, removing.'
-                     ' %s proxies left.' % (proxy, N_FAILS, len(PROXIES)-1))
-        PROXIES.remove(proxy)
-    if len(PROXIES) < N_PROXY_THRESH:
-        LOGGER.fatal('EXIT All proxies hit 503 threshold (%s), exiting' % N_FAILS)
-        exit(1)
+    proxy = proxy or prev_proxy()
+    LOGGER.error('PROXY %s hit 503 Code - %s. %s/%s proxies available.'
+                 % (proxy, PROXY_MANAGER.summary(proxy),
+                    PROXY_MANAGER.n_available(), len(PROXIES)))
 
 
-def check_captcha(ex, url, exit_on_many_503s=False, manual_solve=True):
+CAPTCHAS = counter('captchas_total', 'reverse searches met with a captcha,'
+                   ' by what was done about it', ('action',))
+
+
+def check_captcha(ex, url, exit_on_many_503s=False, manual_solve=True,
+                  proxy=None):
     ret = None
-    if isinstance(ex, BadStatusCode) and ex.code == 503:
+    if isinstance(ex, BadStatusCode) and ex.code in CAPTCHA_CODES:
+        CAPTCHAS.inc(action='check' if exit_on_many_503s
+                     else CAPTCHA_MODE if manual_solve else 'none')
         if exit_on_many_503s:
-            check_proxies()
+            check_proxies(proxy)
         elif manual_solve:
-            ip = None if not PROXIES else prev_proxy()
-            # TODO FIXME
-            ret = reverse_search_selenium(ip, url)
+            ip = None if not PROXIES else proxy or prev_proxy()
+            ret = reverse_search_selenium(ip, url,
+                                          manual=CAPTCHA_MODE == 'block')
         return ' (Captcha?)', ret
     return '', ret
 
@@ -91,56 +130,213 @@ def REVERSE_QUERY_URL(url, lang=None, shuffle_params=True, encode=True):
     return 'https://www.google.com/searchbyimage?' + '&'.join(params)
 
 
-def bare_bones(url, lang=None, msg='', shuffle_params=True):
-    query_url = REVERSE_QUERY_URL(url, lang, shuffle_params)
-    LOGGER.info('START RETRY Reverse%s - %s' % (msg, query_url))
-    is_web_err = True
-    try:
-        resp = retry(query_url, sleep=(2., 3.), n_tries=1)
-        is_web_err = False
-        pred = parse_reverse_prediction(resp)
-        LOGGER.info('DONE RETRY Reverse%s [%s] - %s\n\t- Success on Proxy: %s'
-                    % (msg, pred, query_url, prev_proxy()))
-        return pred
-    except Exception as ex:
-        prefix = '\nFAIL: FINAL RETRY' if is_web_err else ''
-        captcha_msg, ret = check_captcha(ex, query_url, False, False)
-        if ret: return ret
-        log_web_err(query_url, prefix=prefix, extra_err_msg=captcha_msg)
+# every try reshuffles the params and may go out on another proxy, so
+# 503s (captchas) are retried along with connection errors
+REVERSE_POLICY = RetryPolicy(n_tries=3, backoff=DecorrelatedJitter(2., 30.),
+                             retry_on=(RETRYABLE, CAPTCHA))
 
 
 def reverse_search_url(url, lang=None, msg='',
                        shuffle_params=True,
-                       n_tries=2, debug=None):
-    query_url = REVERSE_QUERY_URL(url, lang, shuffle_params)
-    if debug:
-        print('Reversing %s: %s' % (msg, query_url))
-    LOGGER.info('START Reverse%s - %s' % (msg, query_url))
-    is_web_err = True
+                       n_tries=None, debug=None, proxy=None,
+                       policy=None, manual_solve=True, max_inflight=None):
+    policy = policy or REVERSE_POLICY
+    if is_(n_tries) and n_tries != policy.n_tries:
+        policy = copy.copy(policy)
+        policy.n_tries = n_tries
+    state = {'query_url': None, 'web_err': True}
+
+    def attempt(i, timeout):
+        query_url = state['query_url'] = \
+            REVERSE_QUERY_URL(url, lang, shuffle_params)
+        if debug:
+            print('Reversing %s: %s' % (msg, query_url))
+        LOGGER.info('START Reverse%s%s - %s',
+                    msg, ' (try %s)' % (i+1) if i else '', query_url)
+        state['web_err'] = True
+        resp = request(query_url, sleep=(2., 3.), proxy=proxy,
+                       cached=True, valid=has_prediction,
+                       max_inflight=max_inflight, timeout=timeout)
+        if resp.status_code != 200:
+            raise BadStatusCode(resp.status_code)
+        state['web_err'] = False
+        return parse_reverse_prediction(resp)
+
+    def on_retry(ex, kind, i, delay):
+        prefix = '\nBAD REQUEST (%s), RETRY (%s/%s) in %.1fs' \
+                 % (kind, i+2, policy.n_tries, delay)
+        log_web_err(state['query_url'], proxy, kind='warning', prefix=prefix)
+
     try:
-        resp = retry(query_url, sleep=(2., 3.), n_tries=n_tries)
-        is_web_err = False
-        pred = parse_reverse_prediction(resp)
-        LOGGER.info('DONE Reverse%s [%s] - %s\n\t- Success on Proxy: %s'
-                    % (msg, pred, query_url, prev_proxy()))
+        pred = policy.run(attempt, on_retry)
+        LOGGER.info('DONE Reverse%s [%s] - %s\n\t- Success on Proxy: %s',
+                    msg, pred, state['query_url'], proxy or prev_proxy())
         return pred
     except Exception as ex:
-        prefix = '\nFAIL: USED ALL RETRIES' if is_web_err else ''
-        captcha_msg, ret = check_captcha(ex, query_url)
+        query_url = state['query_url']
+        prefix = '\nFAIL: USED ALL RETRIES' if state['web_err'] else ''
+        captcha_msg, ret = check_captcha(ex, query_url, False, manual_solve,
+                                         proxy)
         if ret: return ret
-        log_web_err(query_url, prefix=prefix, extra_err_msg=captcha_msg)
-        if captcha_msg:
-            return bare_bones(url, lang, msg)
+        log_web_err(query_url, proxy, prefix=prefix,
+                    extra_err_msg=captcha_msg)
+        if captcha_msg and manual_solve and CAPTCHA_MODE == 'defer':
+            LOGGER.info('DEFER Reverse%s - %s', msg, query_url)
+            return Deferred(query_url, None if not PROXIES
+                            else proxy or prev_proxy())
+
+
+def search_one(i, url, lang=None, debug=None, known=None, on_result=None,
+               max_inflight=None):
+    # known: {url: pred} finished in an earlier run, reused as is;
+    # on_result(i, url, pred or None) reports each finished search;
+    # max_inflight: see web.request
+    if known and url in known:
+        LOGGER.info('SKIP Reverse #%s [%s] - done earlier', i, known[url])
+        return known[url]
+    pred = reverse_search_url(url, lang, msg=' #%s' % i, debug=debug,
+                              max_inflight=max_inflight)
+    if on_result and not isinstance(pred, Deferred):
+        on_result(i, url, pred if pred and pred.strip() else None)
+    return pred
+
+
+### concurrent
+
+# max reverse searches in flight per proxy (or for the bare IP)
+N_PER_PROXY = 2
+
+
+def deferred_positions(results, n_urls, n_img):
+    # (pos, i) for deferred searches ranked among the returned preds
+    pos = 0
+    for i in range(n_urls):
+        if pos >= n_img or i not in results:
+            break
+        if isinstance(results[i], Deferred):
+            yield pos, i
+        elif results[i]:
+            pos += 1
+
+
+def early_stop_log(query, early_stop, n_saved):
+    early_stop.n_saved = n_saved
+    LOGGER.info('EARLY STOP Reverse for: %s %s, saved >= %s requests',
+                query, early_stop, n_saved)
+
+
+def ordered_preds(results, n_urls, n_img):
+    # preds in image order, and whether they are final: the first n_img
+    # non-empty preds all precede the first url still being searched
+    preds = []
+    for i in range(n_urls):
+        if len(preds) >= n_img:
+            break
+        if i not in results:
+            return preds, False
+        if results[i]:
+            preds.append(results[i])
+    return preds, True
+
+
+async def reverse_search_urls_async(query, *urls, lang=None, n_img=20,
+                                    debug=None, n_workers=8,
+                                    per_proxy=N_PER_PROXY, deferred=None,
+                                    known=None, on_result=None,
+                                    early_stop=None):
+    LOGGER.info('START (Phase 2) Reverse Search for: %s\n', query)
+    # each request goes to the healthiest proxy with a free slot; the
+    # limit is this call's, other callers keep the manager's own
+    max_inflight = per_proxy if PROXIES else None
+    if not PROXIES:
+        n_workers = min(n_workers, per_proxy)
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(n_workers)
+    results = {}
+
+    async def search(i):
+        try:
+            pred = await loop.run_in_executor(executor, partial(
+                search_one, i, urls[i], lang, debug, known, on_result,
+                max_inflight))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log_web_err(urls[i], prefix='\nFAIL: Reverse #%s' % i)
+            pred = None
+        results[i] = pred if pred and pred.strip() \
+            or isinstance(pred, Deferred) else None
+
+    pending, next_i, stopped = set(), 0, False
+    try:
+        while True:
+            preds, final = ordered_preds(results, len(urls), n_img)
+            if final:
+                break
+            if early_stop:
+                # only the ordered prefix counts, as in a serial run
+                for pred in preds[early_stop.n_preds:]:
+                    early_stop.add(pred)
+                stopped = early_stop.converged(n_img - len(preds))
+                if stopped:
+                    early_stop_log(query, early_stop, max(0, min(
+                        n_img - len(preds), len(urls) - next_i)))
+                    break
+            # never launch more searches than could still be needed
+            n_found = sum(1 for pred in results.values() if pred)
+            while next_i < len(urls) and len(pending) < n_workers \
+                    and n_found + len(pending) < n_img:
+                pending.add(asyncio.ensure_future(search(next_i)))
+                next_i += 1
+            if not pending:
+                break
+            _, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in pending:
+            task.cancel()
+        # searches already on the wire finish in the background
+        executor.shutdown(wait=False)
+
+    if deferred is not None:
+        deferred.extend((pos, urls[i], results[i]) for pos, i in
+                        deferred_positions(results, len(urls),
+                                           len(preds) if stopped else n_img))
+
+    LOGGER.info('\nDONE (Phase 2) Reverse Search for: %s (%s/%s searched,'
+                ' %s cancelled)\n', query, len(results), len(urls),
+                len(pending))
+    return preds
 
 
-def reverse_search_urls(query, *urls, lang=None, n_img=20, debug=None):
-    LOGGER.info('START (Phase 2) Reverse Search for: %s\n' % query)
+def reverse_search_urls(query, *urls, lang=None, n_img=20, debug=None,
+                        n_workers=None, per_proxy=N_PER_PROXY,
+                        deferred=None, known=None, on_result=None,
+                        early_stop=None):
+    # deferred: if a list, gets a (pos, url, Deferred) for each search
+    # left to the captcha queue, pos being its rank among the preds;
+    # known, on_result: see search_one; early_stop: a
+    # filter_predictions.EarlyStop, ends the search once it converges
+    if n_workers and n_workers > 1:
+        return asyncio.run(reverse_search_urls_async(
+            query, *urls, lang=lang, n_img=n_img, debug=debug,
+            n_workers=n_workers, per_proxy=per_proxy, deferred=deferred,
+            known=known, on_result=on_result, early_stop=early_stop))
+    LOGGER.info('START (Phase 2) Reverse Search for: %s\n', query)
     preds = []
     for i, url in enumerate(urls):
         if len(preds) >= n_img:
             break
-        pred = reverse_search_url(url, lang, msg=' #%s' % i, debug=debug)
+        pred = search_one(i, url, lang, debug, known, on_result)
         if pred and pred.strip():
             preds.append(pred)
-    LOGGER.info('\nDONE (Phase 2) Reverse Search for: %s\n' % query)
+            if early_stop and len(preds) < n_img:
+                early_stop.add(pred)
+                if early_stop.converged(n_img - len(preds)):
+                    early_stop_log(query, early_stop, min(
+                        n_img - len(preds), len(urls) - i - 1))
+                    break
+        elif isinstance(pred, Deferred) and deferred is not None:
+            deferred.append((len(preds), url, pred))
+    LOGGER.info('\nDONE (Phase 2) Reverse Search for: %s\n', query)
     return preds
@@ -1,21 +1,49 @@
+import os
+import sys
 import time
+import shutil
+import threading
 import subprocess as subp
 
+from contextlib import contextmanager
+
 from selenium import webdriver
+from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.common import action_chains
-from selenium.webdriver.common.proxy import Proxy, ProxyType
-from selenium.common.exceptions import NoSuchElementException
+from selenium.webdriver.chrome.service import Service
+from selenium.common.exceptions import (
+    NoSuchElementException,
+    WebDriverException,
+)
+
+from utils import get_logger
+
+
+LOGGER = get_logger(__name__)
+
 
-import reverse_image_search as ris
+# chromedriver binary: $CHROMEDRIVER, else whatever is on the PATH
+CHROMEDRIVER = os.environ.get('CHROMEDRIVER') or shutil.which('chromedriver')
+
+if sys.platform == 'darwin':
+    BROWSER = 'Google Chrome.app'
+else:
+    BROWSER = os.environ.get('BROWSER') or shutil.which('google-chrome') \
+        or shutil.which('chromium') or 'chromium-browser'
 
 
 def browse(url, host=None, port=None,
            duration=None, stop='cont',
-           browser_path='Google Chrome.app'):
-    browser = ['open', '-a', browser_path, url]
-    if host and port:
-        browser.extend(['--args', '--proxy-server=%s:%s' % (host, port)])
+           browser_path=BROWSER):
+    proxy_args = ['--proxy-server=%s:%s' % (host, port)] \
+        if host and port else []
+    if sys.platform == 'darwin':
+        browser = ['open', '-a', browser_path, url]
+        if proxy_args:
+            browser.extend(['--args'] + proxy_args)
+    else:
+        browser = [browser_path, url] + proxy_args
     child = subp.Popen(browser)
     if duration:
         time.sleep(duration)
@@ -25,29 +53,10 @@ def browse(url, host=None, port=None,
     child.terminate()
 
 
-def capabilities(ip=None, port='3128', ext=False):
-    capabs = {}
-    if ip:
-        proxy = Proxy()
-        proxy.proxy_type  = ProxyType.MANUAL
-        proxy.http_proxy  = ip + ':' + port
-        proxy.socks_proxy = ip + ':' + port
-        proxy.ssl_proxy   = ip + ':' + port
-        capabs = webdriver.DesiredCapabilities.CHROME
-        proxy.add_to_capabilities(capabs)
-    if ext: # FIXME
-        capabs = {**capabs, **{'chromeOptions': {
-            'useAutomationExtension': False,
-            'forceDevToolsScreenshot': True,
-            'args': ['--start-maximized',
-                     '--disable-infobars']
-        }}}
-    return capabs or None
-
-
 def options(no_automate=True,
             no_ext=False, maximize=False, no_infobars=False,
-            cookies=None, no_sandbox=False, headless=False):
+            cookies=None, no_sandbox=False, headless=False, proxy=None):
+    # proxy: host:port every request of the browser goes through
     if not any(locals().values()): return
     ops = webdriver.ChromeOptions()
     if no_automate:
@@ -65,18 +74,20 @@ def options(no_automate=True,
         ops.add_argument('--no-sandbox')
     if headless:
         ops.add_argument('--headless')
+    if proxy:
+        ops.add_argument('--proxy-server=%s' % proxy)
     return ops
 
 
 def captcha(driver, url, click=False, after=3):
     driver.get(url)
-    iframes = driver.find_elements_by_tag_name("iframe")
+    iframes = driver.find_elements(By.TAG_NAME, "iframe")
     driver.switch_to.frame(iframes[0])
     checkbox = None
     xpath = '//div[@class="recaptcha-checkbox-checkmark"' \
             ' and @role="presentation"]'
     try:
-        checkbox = driver.find_element_by_xpath(xpath)
+        checkbox = driver.find_element(By.XPATH, xpath)
     except NoSuchElementException:
         print('no xpath found!')
         return
@@ -92,7 +103,7 @@ def captcha(driver, url, click=False, after=3):
 
 
 def paused_browser(driver, url, stop='cont', duration=None,
-                   after=5, get=True, on_solve=None):
+                   after=5, get=True, on_solve=None, quit=True):
     if get:
         driver.get(url)
     if duration:
@@ -101,38 +112,203 @@ def paused_browser(driver, url, stop='cont', duration=None,
         while input('Enter "cont" to continue:') != stop:
             pass
     info = on_solve(driver) if on_solve else None
-    driver.quit()
+    if quit:
+        driver.quit()
     time.sleep(after)
     return info
 
 
 def parse_reverse_selenium(driver):
-    return ris.parse_reverse_prediction(driver.page_source,
-                                        from_request=False)
+    # imported here: reverse_image_search imports this module
+    from reverse_image_search import parse_reverse_prediction
+    return parse_reverse_prediction(driver.page_source, from_request=False)
+
+
+### driver pool
+
+# pages a driver serves before it is replaced
+MAX_PAGES = 50
+# drivers per proxy (or for the bare IP)
+DRIVERS_PER_PROXY = 1
+HEADLESS = True
+
+
+class DriverPool(object):
+    """
+    warm webdrivers, each bound to a proxy, leased one page at a time;
+    drivers failing a health check or past max_pages are quit and
+    replaced on the next lease
+    """
+    def __init__(self, per_proxy=DRIVERS_PER_PROXY, max_pages=MAX_PAGES,
+                 headless=HEADLESS, chrome_path=None, factory=None):
+        self.per_proxy = per_proxy
+        self.max_pages = max_pages
+        self.factory = factory or (lambda ip: proxy_driver(
+            ip, chrome_path, headless=headless))
+        self.cond = threading.Condition()
+        self.idle = {}    # ip -> [driver]
+        self.n_live = {}  # ip -> drivers created and not quit
+        self.pages = {}   # driver -> pages served
+        self.counts = {'created': 0, 'recycled': 0, 'unhealthy': 0,
+                       'leases': 0}
+
+    @staticmethod
+    def healthy(driver):
+        try:
+            return driver.execute_script('return 1') == 1
+        except Exception:
+            return False
+
+    def drop(self, driver, ip):
+        # callers hold the lock, and quit the driver once they let go of
+        # it: quitting a hung driver can hang too
+        self.pages.pop(driver, None)
+        self.n_live[ip] -= 1
+        self.cond.notify_all()
+
+    @staticmethod
+    def quit(driver):
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    def acquire(self, ip=None):
+        while True:
+            with self.cond:
+                self.n_live.setdefault(ip, 0)
+                idle = self.idle.setdefault(ip, [])
+                if idle:
+                    driver = idle.pop()
+                elif self.n_live[ip] < self.per_proxy:
+                    self.n_live[ip] += 1
+                    break
+                else:
+                    self.cond.wait()
+                    continue
+            # probed outside the lock: a hung driver only holds up this
+            # lease, not every other checkout
+            if self.healthy(driver):
+                with self.cond:
+                    self.counts['leases'] += 1
+                return driver
+            with self.cond:
+                self.counts['unhealthy'] += 1
+                self.drop(driver, ip)
+            self.quit(driver)
+        try:
+            driver = self.factory(ip)
+        except:
+            with self.cond:
+                self.n_live[ip] -= 1
+                self.cond.notify_all()
+            raise
+        with self.cond:
+            self.pages[driver] = 0
+            self.counts['created'] += 1
+            self.counts['leases'] += 1
+        return driver
+
+    def release(self, driver, ip=None, broken=False):
+        with self.cond:
+            self.pages[driver] += 1
+            recycle = broken or self.pages[driver] >= self.max_pages
+            if recycle:
+                self.counts['recycled'] += 1
+                self.drop(driver, ip)
+            else:
+                self.idle[ip].append(driver)
+                self.cond.notify_all()
+        if recycle:
+            self.quit(driver)
+
+    @contextmanager
+    def lease(self, ip=None):
+        driver = self.acquire(ip)
+        broken = False
+        try:
+            yield driver
+        except WebDriverException:
+            broken = True
+            raise
+        finally:
+            self.release(driver, ip, broken)
+
+    def close(self):
+        dropped = []
+        with self.cond:
+            for ip, drivers in self.idle.items():
+                while drivers:
+                    driver = drivers.pop()
+                    self.drop(driver, ip)
+                    dropped.append(driver)
+        for driver in dropped:
+            self.quit(driver)
+
+    def stats(self):
+        with self.cond:
+            return {**self.counts, 'live': sum(self.n_live.values()),
+                    'idle': sum(map(len, self.idle.values()))}
+
+
+DRIVER_POOL = DriverPool()
 
 
 def reverse_search_selenium(ip, url, stop='cont',
-                            duration=None, after=5):
-    driver = proxy_driver(ip)
-    driver.get(url)
+                            duration=None, after=5, pool=None, manual=True):
+    # warm headless driver first, a visible one for solving by hand
     try:
-        pred = parse_reverse_selenium(driver)
-        driver.quit()
-        return pred
-    except: pass
+        with (pool or DRIVER_POOL).lease(ip) as driver:
+            driver.get(url)
+            return parse_reverse_selenium(driver)
+    except Exception:
+        LOGGER.warning('Headless reverse search failed, %s: %s',
+                       'solve manually' if manual else 'giving up', url,
+                       exc_info=True)
+        if not manual:
+            return
+    driver = proxy_driver(ip)
     try:
         return paused_browser(driver, url, stop, duration, after,
-                              get=False, on_solve=parse_reverse_selenium)
-    except: pass
-    finally: driver.quit()
+                              on_solve=parse_reverse_selenium, quit=False)
+    except Exception:
+        LOGGER.exception('Manual reverse search failed: %s' % url)
+    finally:
+        DriverPool.quit(driver)
 
 
-def proxy_driver(ip=None, chrome_path='/Applications/chromedriver'):
-    return webdriver.Chrome(chrome_path,
-                            options=options(),
-                            desired_capabilities=capabilities(ip=ip))
+def proxy_driver(ip=None, chrome_path=None, headless=False, port='3128'):
+    # the driver binary goes in a Service; without one, selenium finds
+    # or fetches a chromedriver itself
+    chrome_path = chrome_path or CHROMEDRIVER
+    service = Service(chrome_path) if chrome_path else Service()
+    ops = options(headless=headless,
+                  proxy='%s:%s' % (ip, port) if ip else None)
+    return webdriver.Chrome(service=service, options=ops)
+
+
+def check_pool(url, n_pages=5, pool=None, ip=None):
+    # lease drivers for n_pages loads of url, e.g. a local test page
+    pool = pool or DriverPool(max_pages=2)
+    titles = []
+    try:
+        for _ in range(n_pages):
+            with pool.lease(ip) as driver:
+                driver.get(url)
+                titles.append(driver.title)
+        return titles, pool.stats()
+    finally:
+        pool.close()
 
 
 if __name__ == '__main__':
-    url = 'https://www.google.com/recaptcha/api2/demo'
-    paused_browser(proxy_driver(), url)
\ No newline at end of file
+    from utils import arg, parse_args
+    opts = parse_args(
+        arg('-url', default='https://www.google.com/recaptcha/api2/demo'),
+        # exercise a DriverPool against url instead of pausing on it
+        arg('-pool', type=int),
+    )
+    if opts.pool:
+        print(check_pool(opts.url, opts.pool))
+    else:
+        paused_browser(proxy_driver(), opts.url)
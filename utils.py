@@ -5,13 +5,21 @@ misc utility functions
 import re
 import os
 import errno
+import atexit
 import pickle
 import random
+import sqlite3
 import logging
 import argparse
+import threading
 
 import datetime as dt
 
+import ujson as json
+
+from queue import Queue
+from logging.handlers import QueueHandler, QueueListener
+
 
 RANDOM_SEED = 2018
 
@@ -29,6 +37,50 @@ class UpToLevel(object):
 ROOT = '*'
 
 
+class JsonFormatter(logging.Formatter):
+    # one json object per record, for json-lines logs
+    def format(self, record):
+        entry = {'time': self.formatTime(record, self.datefmt),
+                 'level': record.levelname,
+                 'where': '%s.%s:%s' % (record.module, record.funcName,
+                                        record.lineno),
+                 'thread': record.threadName,
+                 'msg': record.getMessage()}
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False,
+                          escape_forward_slashes=False)
+
+
+class LazyQueueHandler(QueueHandler):
+    # hands records over as they are: the listener thread merges their
+    # args and formats them, not the thread that logged
+    def prepare(self, record):
+        return record
+
+
+class Lazy(object):
+    # a log arg built only if the record is formatted: Lazy(f, *args)
+    def __init__(self, f, *args):
+        self.f = f
+        self.args = args
+
+    def __str__(self):
+        return str(self.f(*self.args))
+
+
+LISTENERS = []
+
+
+def stop_logging():
+    # drain and stop queued logging; call before closing its handlers
+    while LISTENERS:
+        LISTENERS.pop().stop()
+
+
+atexit.register(stop_logging)
+
+
 def init_logging(file=None, stdout=False, stderr=False,
                  lo_lvl=logging.DEBUG, hi_lvl=logging.FATAL,
                  file_lo_lvl=None, stdout_lo_lvl=None, stderr_lo_lvl=None,
@@ -36,13 +88,18 @@ def init_logging(file=None, stdout=False, stderr=False,
                  fmt='[%(asctime)s|%(levelname)s|%(module)s'
                      '.%(funcName)s:%(lineno)d] %(message)s',
                  datefmt='%Y-%m-%d_%H:%M:%S',
-                 mode='w'):
+                 mode='w', queue=False, json_lines=False):
+    """
+    queue: handlers run on a background listener thread, callers only
+    enqueue; json_lines: one json object per record instead of fmt
+    """
     logger = logging.getLogger(ROOT)
     if is_(lo_lvl):
         logger.setLevel(lo_lvl)
     if is_(hi_lvl):
         logger.addFilter(UpToLevel(hi_lvl))
 
+    handlers, file_handler = [], None
     for name, obj, args, prefix in [
         ('stdout', stdout,  [logging.sys.stdout], 'Stream'),
         ('stderr', stderr,                    (), 'Stream'),
@@ -50,16 +107,28 @@ def init_logging(file=None, stdout=False, stderr=False,
     ]:
         if obj:
             handler = getattr(logging, prefix + 'Handler')(*args)
-            handler.setFormatter(logging.Formatter(fmt, datefmt))
+            handler.setFormatter(JsonFormatter(datefmt=datefmt)
+                                 if json_lines
+                                 else logging.Formatter(fmt, datefmt))
             lo, hi = locals()[name+'_lo_lvl'], locals()[name+'_hi_lvl']
             if is_(lo):
                 handler.setLevel(lo)
             if is_(hi):
                 handler.addFilter(UpToLevel(hi))
-            logger.addHandler(handler)
+            handlers.append(handler)
             if name == 'file':
-                return handler
-
+                file_handler = handler
+
+    if queue:
+        listener = QueueListener(Queue(), *handlers,
+                                 respect_handler_level=True)
+        logger.addHandler(LazyQueueHandler(listener.queue))
+        listener.start()
+        LISTENERS.append(listener)
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
+    return file_handler
 
 
 def main_module_name(name, ext=True):
@@ -107,6 +176,30 @@ def mkdir_p(path):
             raise
 
 
+class SqliteStore(object):
+    """
+    one sqlite file behind a lock, shared by threads; WAL lets other
+    processes read it meanwhile. subclasses create their tables
+    """
+    def __init__(self, path, timeout=30, **kw):
+        mkdir_p(os.path.dirname(path) or '.')
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=timeout,
+                                  check_same_thread=False, **kw)
+        self.db.execute('PRAGMA journal_mode=WAL')
+
+    def count_by(self, table, col):
+        # {value: rows} of a column
+        with self.lock:
+            return dict(self.db.execute('SELECT %s, COUNT(*) FROM %s'
+                                        ' GROUP BY %s' % (col, table, col)))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
 def get_path_elems_unix(path, i, j='', delim='_'):
     elems = re.sub('//+', '/', path).strip('/').split('/')
     return elems[i] if j == '' or i == j else delim.join(elems[i:j])
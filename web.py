@@ -1,11 +1,21 @@
 import time
 import random
+import threading
 
 import traceback as tb
 
+from http import cookiejar
+from urllib import parse as urlparse
+
 import requests
 
+from requests.adapters import HTTPAdapter
+
 from utils import is_, get_logger
+from proxy_manager import ProxyManager, outcome, ERROR
+from response_cache import ResponseCache, CachedResponse, TTL, MAX_BYTES
+from retry_policy import RetryPolicy, RETRYABLE, CAPTCHA
+from metrics import counter, gauge, histogram
 
 
 LOGGER = get_logger(__name__)
@@ -58,33 +68,33 @@ else:
 PROXY_HTTP_URL = '%s://%s{ip}:%s/' % (HTTP_PREFIX, PROXY_USER_PASS, HTTP_PORT)
 PROXY_HTTPS_URL = '%s://%s{ip}:%s/' % (HTTPS_PREFIX, PROXY_USER_PASS, HTTPS_PORT)
 
-CURRENT_PROXY = 0
+# max requests in flight per proxy (None for no limit)
+MAX_PER_PROXY = None
+
+PROXY_MANAGER = ProxyManager(PROXIES, MAX_PER_PROXY)
 
 
-def current_proxy(rotate=True):
+def current_proxy():
+    # healthiest proxy right now, without leasing it
     if not PROXIES:
         return 'NO PROXY'
-
-    global CURRENT_PROXY
-    curr_proxy = PROXIES[CURRENT_PROXY]
-    if rotate:
-        CURRENT_PROXY = (CURRENT_PROXY + 1) % len(PROXIES)
-    return curr_proxy
+    return PROXY_MANAGER.peek()
 
 
 def prev_proxy():
+    # proxy of this thread's last request
     if not PROXIES:
         return 'NO PROXY'
-    return PROXIES[(CURRENT_PROXY - 1) % len(PROXIES)]
+    return PROXY_MANAGER.last()
 
 
-def get_proxy(p=None, rotate=True):
+def get_proxy(p=None, healthiest=True):
     if not PROXIES:
         return
 
     if is_(p):
         proxy_addr = p
-    elif rotate:
+    elif healthiest:
         proxy_addr = current_proxy()
     else:
         proxy_addr = random.choice(PROXIES)
@@ -93,6 +103,285 @@ def get_proxy(p=None, rotate=True):
             'https': PROXY_HTTPS_URL.format(ip=proxy_addr)}
 
 
+### sessions
+
+# hosts kept per session, and keep-alive connections kept per host
+POOL_CONNECTIONS = 2
+POOL_MAXSIZE = 8
+
+# seconds an unused session is kept open
+SESSION_IDLE = 300.
+
+
+class SessionPool(object):
+    def __init__(self, pool_connections=POOL_CONNECTIONS,
+                 pool_maxsize=POOL_MAXSIZE, idle=SESSION_IDLE):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.idle = idle
+        self.lock = threading.Lock()
+        # (proxy, host) -> [session, last used]
+        self.sessions = {}
+        self.n_created = self.n_evicted = 0
+        # connection counts of evicted sessions
+        self.closed_counts = [0, 0]
+
+    def new_session(self):
+        session = requests.Session()
+        # stateless like requests.get: no cookies carried between calls
+        session.cookies.set_policy(cookiejar.DefaultCookiePolicy(
+            allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                              pool_maxsize=self.pool_maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def get(self, proxy, url):
+        key = proxy, urlparse.urlsplit(url).netloc.lower()
+        now = time.time()
+        with self.lock:
+            self.evict(now)
+            entry = self.sessions.get(key)
+            if entry is None:
+                entry = self.sessions[key] = [self.new_session(), now]
+                self.n_created += 1
+            entry[1] = now
+            return entry[0]
+
+    def evict(self, now=None, idle=None):
+        # callers hold the lock
+        now, idle = now or time.time(), self.idle if idle is None else idle
+        for key, (session, last_used) in list(self.sessions.items()):
+            if now - last_used >= idle:
+                n_conns, n_reqs = connection_counts(session)
+                self.closed_counts[0] += n_conns
+                self.closed_counts[1] += n_reqs
+                session.close()
+                del self.sessions[key]
+                self.n_evicted += 1
+
+    def close(self):
+        with self.lock:
+            self.evict(idle=0)
+
+    def stats(self):
+        with self.lock:
+            n_conns, n_reqs = self.closed_counts
+            for session, _ in self.sessions.values():
+                c, r = connection_counts(session)
+                n_conns, n_reqs = n_conns + c, n_reqs + r
+            return {'sessions': len(self.sessions),
+                    'created': self.n_created,
+                    'evicted': self.n_evicted,
+                    'connections': n_conns,
+                    'requests': n_reqs,
+                    'reused': n_reqs - n_conns}
+
+
+def connection_pools(session):
+    for adapter in session.adapters.values():
+        managers = [adapter.poolmanager, *adapter.proxy_manager.values()]
+        for manager in managers:
+            for key in manager.pools.keys():
+                pool = manager.pools.get(key)
+                if pool is not None:
+                    yield pool
+
+
+def connection_counts(session):
+    # (connections opened, requests sent) over the session's pools
+    n_conns = n_reqs = 0
+    for pool in connection_pools(session):
+        n_conns += pool.num_connections
+        n_reqs += pool.num_requests
+    return n_conns, n_reqs
+
+
+SESSIONS = SessionPool()
+
+
+### rate limiting
+
+# pace requests with token buckets instead of fixed sleeps
+RATE_LIMIT = True
+
+# (requests per second, burst) for each proxy over all hosts
+PROXY_RATE = (2., 5)
+
+# (requests per second, burst) for each proxy against one host;
+# hosts not listed are only limited by PROXY_RATE
+HOST_RATES = {'www.google.com': (.4, 2)}
+DEFAULT_HOST_RATE = None
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+
+    def refill(self, now):
+        elapsed = max(0., now - self.stamp)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.stamp = now
+
+    def wait_time(self, now, n=1):
+        self.refill(now)
+        return max(0., (n - self.tokens) / self.rate)
+
+    def take(self, n=1):
+        self.tokens -= n
+
+
+class RateLimiter(object):
+    def __init__(self, proxy_rate=PROXY_RATE, host_rates=None,
+                 default_host_rate=DEFAULT_HOST_RATE):
+        self.proxy_rate = proxy_rate
+        self.host_rates = HOST_RATES if host_rates is None else host_rates
+        self.default_host_rate = default_host_rate
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def bucket(self, proxy, host=None):
+        key = proxy, host
+        if key not in self.buckets:
+            rate = self.proxy_rate if host is None else \
+                self.host_rates.get(host, self.default_host_rate)
+            self.buckets[key] = rate and TokenBucket(*rate)
+        return self.buckets[key]
+
+    def buckets_for(self, proxy, url):
+        host = urlparse.urlsplit(url).netloc.lower()
+        buckets = self.bucket(proxy), self.bucket(proxy, host)
+        return [b for b in buckets if b]
+
+    def wait_time(self, proxy, url):
+        # seconds until a request to url through proxy is allowed;
+        # does not block or take a token
+        with self.lock:
+            now = time.monotonic()
+            return max([b.wait_time(now) for b in
+                        self.buckets_for(proxy, url)] or [0.])
+
+    def try_acquire(self, proxy, url):
+        # take a token from every bucket and return 0 if all have one,
+        # else take nothing and return the wait time
+        with self.lock:
+            now = time.monotonic()
+            buckets = self.buckets_for(proxy, url)
+            wait = max([b.wait_time(now) for b in buckets] or [0.])
+            if not wait:
+                for b in buckets:
+                    b.take()
+            return wait
+
+    def acquire(self, proxy, url):
+        waited = 0.
+        while True:
+            wait = self.try_acquire(proxy, url)
+            if not wait:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+
+LIMITER = RateLimiter()
+
+
+def set_rates(proxy_rate=PROXY_RATE, host_rates=None,
+              default_host_rate=DEFAULT_HOST_RATE):
+    global LIMITER
+    LIMITER = RateLimiter(proxy_rate, host_rates, default_host_rate)
+
+
+def wait_time(url, proxy=None):
+    return LIMITER.wait_time(proxy, url) if RATE_LIMIT else 0.
+
+
+### cache
+
+# ResponseCache for requests made with cached=True (None: no caching)
+CACHE = None
+
+
+def set_cache(path, ttl=TTL, max_bytes=MAX_BYTES):
+    global CACHE
+    CACHE = ResponseCache(path, ttl, max_bytes) if is_(path) else None
+    return CACHE
+
+
+### record / replay
+
+# ResponseCache that every response is written to (None: not recording)
+RECORDER = None
+
+# stand-in server that all requests go to instead of the real hosts,
+# e.g. 'http://localhost:8000' for replay_server.py
+BASE_URL = None
+
+
+def set_recorder(path):
+    global RECORDER
+    RECORDER = ResponseCache(path, ttl=None, max_bytes=None) \
+        if is_(path) else None
+    return RECORDER
+
+
+def recording():
+    return is_(RECORDER)
+
+
+def record(url, resp, content):
+    # a streamed response, once its caller has read the body whole
+    if is_(RECORDER):
+        RECORDER.put(url, CachedResponse(url, resp.status_code, content,
+                                         resp.headers))
+
+
+def set_base_url(url):
+    global BASE_URL
+    BASE_URL = url.rstrip('/') if url else None
+
+
+def rewrite_url(url):
+    # https://host/path?q -> BASE_URL/https/host/path?q
+    if not is_(BASE_URL):
+        return url
+    parts = urlparse.urlsplit(url)
+    path = '/'.join((BASE_URL, parts.scheme, parts.netloc + parts.path))
+    return path + ('?' + parts.query if parts.query else '')
+
+
+### metrics
+
+REQUEST_SECONDS = histogram('http_request_seconds',
+                            'time to a response, after rate limiting',
+                            ('proxy', 'endpoint'))
+REQUESTS = counter('http_requests_total', 'requests by outcome',
+                   ('proxy', 'endpoint', 'outcome'))
+CACHE_HITS = counter('http_cache_hits_total', 'responses from the cache',
+                     ('endpoint',))
+BYTES = counter('http_bytes_total', 'response bytes downloaded',
+                ('endpoint',))
+gauge('proxies_available', 'proxies whose circuit breaker is not open') \
+    .set_function(lambda: PROXY_MANAGER.n_available())
+
+
+def endpoint(url):
+    # google endpoints by path, image hosts lumped together
+    parts = urlparse.urlsplit(url)
+    if parts.netloc in HOST_RATES:
+        return parts.netloc + '/' + parts.path.strip('/').split('/')[0]
+    return 'other'
+
+
+def count_bytes(url, n):
+    # for streamed responses, which request() can't measure
+    BYTES.inc(n, endpoint=endpoint(url))
+
+
 ### requests
 
 def slp(o):
@@ -104,13 +393,62 @@ def slp(o):
         time.sleep(a)
 
 
-def request(url, kind='get', sleep=None, **kw):
-    resp = getattr(requests, kind)(url,
-                                   headers=get_ua(),
-                                   proxies=get_proxy(),
-                                   **kw)
-    if is_(sleep):
+def pace(sleep):
+    # fixed sleeps are only used when the rate limiter is off
+    if not RATE_LIMIT and is_(sleep):
         slp(sleep)
+
+
+def request(url, kind='get', sleep=None, proxy=None, cached=False,
+            valid=None, max_inflight=None, **kw):
+    # valid(resp): whether a 200 page is worth caching, e.g. not a
+    # captcha; cached pages it rejects are fetched again. max_inflight:
+    # only pick proxies with fewer requests on the wire
+    cached = cached and is_(CACHE) and kind == 'get'
+    if cached:
+        resp = CACHE.get(url)
+        if is_(resp) and (valid is None or valid(resp)):
+            CACHE_HITS.inc(endpoint=endpoint(url))
+            if is_(RECORDER):
+                RECORDER.put(url, resp)
+            return resp
+    # a stand-in server is local: no proxies or pacing
+    live = not is_(BASE_URL)
+    use_proxy = PROXIES and live
+    if use_proxy:
+        proxy = PROXY_MANAGER.begin(proxy) if is_(proxy) \
+            else PROXY_MANAGER.choose(max_inflight)
+    target = rewrite_url(url)
+    session = SESSIONS.get(proxy, target)
+    result, start = ERROR, time.time()
+    try:
+        if RATE_LIMIT and live:
+            LIMITER.acquire(proxy, url)
+            start = time.time()
+        resp = getattr(session, kind)(target,
+                                      headers=get_ua(),
+                                      proxies=get_proxy(proxy)
+                                              if use_proxy else None,
+                                      **kw)
+        result = outcome(resp.status_code)
+    finally:
+        elapsed, point = time.time() - start, endpoint(url)
+        if use_proxy:
+            PROXY_MANAGER.end(proxy, elapsed, result)
+        REQUEST_SECONDS.observe(elapsed, proxy=proxy or 'direct',
+                                endpoint=point)
+        REQUESTS.inc(proxy=proxy or 'direct', endpoint=point,
+                     outcome=result)
+    # reading a streamed body here would load it whole: streamed
+    # downloads count their own bytes and record() what they read
+    if not kw.get('stream'):
+        BYTES.inc(len(resp.content), endpoint=point)
+        if is_(RECORDER) and kind == 'get':
+            RECORDER.put(url, resp)
+    if cached and resp.status_code == 200 and (valid is None or valid(resp)):
+        CACHE.put(url, resp)
+    if live:
+        pace(sleep)
     return resp
 
 
@@ -122,29 +460,35 @@ class BadStatusCode(Exception):
 
 def log_web_err(url, proxy=None, err_str=None, prefix='',
                 kind='error', extra_err_msg=None):
-    err_msg = prefix + '\nURL: %s\nProxy: %s\nErr:%s %s' \
-              % (url, proxy or prev_proxy(), extra_err_msg,
-                 err_str or tb.format_exc())
-    getattr(LOGGER, kind)(err_msg)
+    # the traceback is taken here, it's gone once the handler returns
+    getattr(LOGGER, kind)('%s\nURL: %s\nProxy: %s\nErr:%s %s', prefix, url,
+                          proxy or prev_proxy(), extra_err_msg,
+                          err_str or tb.format_exc())
 
 
 def retry(url, requestor=None, n_tries=2, sleep=None,
-          good_codes=(200,), reraise=True, always_sleep=True):
-    do_request = (lambda: requestor(url)) if is_(requestor) \
-            else (lambda: request(url))
-    for i in range(n_tries):
-        try:
-            r = do_request()
-            if always_sleep and is_(sleep):
-                slp(sleep)
-            if r.status_code in good_codes:
-                return r
-            raise BadStatusCode(r.status_code)
-        except:
-            if i >= n_tries - 1:
-                if reraise: raise
-                else: return
-            prefix = '\nBAD REQUEST, RETRY (%s/%s)' % (i+2, n_tries)
-            log_web_err(url, kind='warning', prefix=prefix)
-            if not always_sleep and is_(sleep):
-                slp(sleep)
\ No newline at end of file
+          good_codes=(200,), reraise=True, always_sleep=True,
+          policy=None, **kw):
+    policy = policy or RetryPolicy(n_tries, retry_on=(RETRYABLE, CAPTCHA))
+
+    def attempt(i, timeout):
+        if is_(requestor):
+            r = requestor(url)
+        else:
+            r = request(url, **{'timeout': timeout, **kw})
+        if always_sleep or r.status_code not in good_codes:
+            pace(sleep)
+        if r.status_code in good_codes:
+            return r
+        raise BadStatusCode(r.status_code)
+
+    def on_retry(ex, kind, i, delay):
+        prefix = '\nBAD REQUEST (%s), RETRY (%s/%s) in %.1fs' \
+                 % (kind, i+2, policy.n_tries, delay)
+        log_web_err(url, proxy=kw.get('proxy'),
+                    kind='warning', prefix=prefix)
+
+    try:
+        return policy.run(attempt, on_retry)
+    except:
+        if reraise: raise
@@ -0,0 +1,234 @@
+"""
+leased work queue for running main.py on several hosts. workers lease
+words (or any keyed task) for a while, heartbeat to keep them, and
+write results back; leases that expire go back to the queue.
+
+each lease carries a fencing token that is bumped on every new lease,
+so a worker that lost its lease (paused, partitioned) can't complete a
+task someone else now holds. the sqlite backend needs a filesystem with
+working locks shared by the workers; a backend with the same methods
+can replace it.
+
+    python work_queue.py -queue q.sqlite [-put word ...]
+"""
+
+import os
+import time
+import socket
+import sqlite3
+import threading
+
+import ujson as json
+
+from utils import (
+    arg,
+    parse_args,
+    get_logger,
+    init_logging,
+    SqliteStore,
+)
+
+
+LOGGER = get_logger(__name__)
+
+
+PENDING, LEASED, DONE, FAILED = 'pending', 'leased', 'done', 'failed'
+
+# seconds a lease lasts without a heartbeat
+LEASE_TTL = 600.
+
+# leases given to a task before it is failed for good
+MAX_ATTEMPTS = 3
+
+
+def worker_id():
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+
+class Lease(object):
+    def __init__(self, id_, key, payload, token, owner):
+        self.id = id_
+        self.key = key
+        self.payload = payload
+        self.token = token
+        self.owner = owner
+
+    def __repr__(self):
+        return '<Lease #%s %s token %s>' % (self.id, self.key, self.token)
+
+
+class WorkQueue(SqliteStore):
+    def __init__(self, path, ttl=LEASE_TTL, max_attempts=MAX_ATTEMPTS):
+        # transactions are explicit: leasing is a read-then-write
+        super().__init__(path, timeout=60, isolation_level=None)
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.db.execute('CREATE TABLE IF NOT EXISTS tasks ('
+                        ' id INTEGER PRIMARY KEY, key TEXT UNIQUE,'
+                        ' payload TEXT, status TEXT, owner TEXT,'
+                        ' lease_until REAL, token INTEGER DEFAULT 0,'
+                        ' attempts INTEGER DEFAULT 0, result TEXT,'
+                        ' error TEXT, updated REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS tasks_status'
+                        ' ON tasks (status, id)')
+
+    def transaction(self, f, *args):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                ret = f(*args)
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+            return ret
+
+    def put(self, keys, payloads=None):
+        # -> number of new tasks; keys already queued are left alone
+        payloads = payloads or [None] * len(keys)
+        def _put():
+            n = 0
+            for key, payload in zip(keys, payloads):
+                n += self.db.execute(
+                    'INSERT OR IGNORE INTO tasks (key, payload, status,'
+                    ' updated) VALUES (?,?,?,?)',
+                    (key, json.dumps(payload), PENDING,
+                     time.time())).rowcount
+            return n
+        return self.transaction(_put)
+
+    def requeue_expired(self, now):
+        # callers are in a transaction
+        self.db.execute('UPDATE tasks SET status = ?, error = ?,'
+                        ' updated = ? WHERE status = ? AND lease_until < ?'
+                        ' AND attempts >= ?',
+                        (FAILED, 'lease expired', now, LEASED, now,
+                         self.max_attempts))
+        n = self.db.execute('UPDATE tasks SET status = ?, owner = NULL,'
+                            ' updated = ? WHERE status = ?'
+                            ' AND lease_until < ?',
+                            (PENDING, now, LEASED, now)).rowcount
+        if n:
+            LOGGER.info('Requeued %s expired leases' % n)
+
+    def lease(self, owner=None, n=1, ttl=None):
+        # -> up to n Leases, oldest tasks first
+        owner, ttl = owner or worker_id(), ttl or self.ttl
+        def _lease():
+            now = time.time()
+            self.requeue_expired(now)
+            rows = self.db.execute('SELECT id, key, payload, token'
+                                   ' FROM tasks WHERE status = ?'
+                                   ' ORDER BY id LIMIT ?',
+                                   (PENDING, n)).fetchall()
+            leases = []
+            for id_, key, payload, token in rows:
+                self.db.execute('UPDATE tasks SET status = ?, owner = ?,'
+                                ' lease_until = ?, token = ?,'
+                                ' attempts = attempts + 1, updated = ?'
+                                ' WHERE id = ?',
+                                (LEASED, owner, now + ttl, token + 1, now,
+                                 id_))
+                leases.append(Lease(id_, key, json.loads(payload),
+                                    token + 1, owner))
+            return leases
+        return self.transaction(_lease)
+
+    def fenced(self, lease, sql, args):
+        # runs sql only while `lease` still holds its task
+        def _fenced():
+            return self.db.execute(
+                sql + ' WHERE id = ? AND token = ? AND status = ?',
+                tuple(args) + (lease.id, lease.token, LEASED)).rowcount == 1
+        return self.transaction(_fenced)
+
+    def heartbeat(self, lease, ttl=None):
+        # -> False if the lease was lost
+        now = time.time()
+        return self.fenced(lease, 'UPDATE tasks SET lease_until = ?,'
+                           ' updated = ?', (now + (ttl or self.ttl), now))
+
+    def complete(self, lease, result=None):
+        # -> False if the lease was lost, the result is then dropped
+        return self.fenced(lease, 'UPDATE tasks SET status = ?, result = ?,'
+                           ' owner = NULL, updated = ?',
+                           (DONE, json.dumps(result), time.time()))
+
+    def fail(self, lease, error=None, retry=True):
+        # back to the queue, unless out of attempts
+        return self.fenced(lease, 'UPDATE tasks SET status = CASE WHEN ?'
+                           ' AND attempts < ? THEN ? ELSE ? END,'
+                           ' error = ?, owner = NULL, updated = ?',
+                           (retry, self.max_attempts, PENDING, FAILED,
+                            error, time.time()))
+
+    def results(self):
+        with self.lock:
+            rows = self.db.execute('SELECT key, result FROM tasks'
+                                   ' WHERE status = ? ORDER BY id',
+                                   (DONE,)).fetchall()
+        return [(key, json.loads(result)) for key, result in rows]
+
+    def stats(self):
+        return self.count_by('tasks', 'status')
+
+
+class Heartbeat(object):
+    """
+    renews a lease in the background while its task runs; `lost` is set
+    once a renewal fails, and the task's result will be refused
+    """
+    def __init__(self, queue, lease, every=None):
+        self.queue = queue
+        self.lease = lease
+        self.every = every or queue.ttl / 3.
+        self.lost = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.every):
+            try:
+                ok = self.queue.heartbeat(self.lease)
+            except sqlite3.Error:
+                LOGGER.exception('Heartbeat failed for %s' % self.lease)
+                continue
+            if not ok:
+                LOGGER.warning('Lost %s' % self.lease)
+                self.lost.set()
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def leases(queue, owner=None, wait=None):
+    # one lease at a time until the queue is drained; with `wait`, keep
+    # polling every `wait` seconds while other workers hold leases
+    while True:
+        leased = queue.lease(owner)
+        if leased:
+            yield leased[0]
+            continue
+        if not wait or not queue.stats().get(LEASED):
+            return
+        time.sleep(wait)
+
+
+if __name__ == '__main__':
+    opts = parse_args(
+        arg('-queue', default=os.path.join('.cache', 'work.sqlite')),
+        # put these words on the queue
+        arg('-put', nargs='*'),
+    )
+    init_logging(stdout=True)
+    queue = WorkQueue(opts.queue)
+    if opts.put:
+        LOGGER.info('Queued %s new tasks' % queue.put(opts.put))
+    LOGGER.info('Queue: %s' % queue.stats())
+    queue.close()